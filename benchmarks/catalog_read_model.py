@@ -0,0 +1,154 @@
+"""Catalog queries on the live products table versus the catalog read model.
+
+Usage:
+    python benchmarks/catalog_read_model.py --products 200000 --categories 50
+
+Compares, without the response cache:
+- category listing with product count and price range: aggregate over
+  approved products versus one read of category_stats
+- faceted product search (category + price range + vendor name): live
+  products joined with categories and vendors versus catalog_products
+It also times the incremental maintenance done by sync_catalog_product
+when a product is updated.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from main import Category, CatalogProduct, CategoryStats, Product, ProductStatus, User, func  # noqa: E402
+
+
+def seed(products: int, categories: int, vendors: int):
+    db = main.SessionLocal()
+    db.execute(Category.__table__.insert(), [{"name": f"category {i}"} for i in range(categories)])
+    db.execute(User.__table__.insert(), [
+        {
+            "email": f"vendor{i}@bench.test",
+            "username": f"vendor{i}",
+            "business_name": f"Boutique {i}",
+            "hashed_password": "-",
+            "role": main.UserRole.VENDOR.name,
+            "is_active": True,
+            "is_verified": True,
+        }
+        for i in range(vendors)
+    ])
+    batch = 10000
+    for start in range(0, products, batch):
+        db.execute(Product.__table__.insert(), [
+            {
+                "name": f"Product {i}",
+                "price": random.randint(500, 500000),
+                "stock": 10,
+                "status": (ProductStatus.APPROVED if i % 10 else ProductStatus.PENDING).name,
+                "category_id": random.randint(1, categories),
+                "vendor_id": random.randint(1, vendors),
+            }
+            for i in range(start, min(start + batch, products))
+        ])
+    main.rebuild_catalog_read_model(db)
+    db.commit()
+    db.close()
+
+
+def live_categories(db):
+    return db.query(
+        Category.id, Category.name, func.count(Product.id), func.min(Product.price), func.max(Product.price)
+    ).outerjoin(
+        Product, (Product.category_id == Category.id) & (Product.status == ProductStatus.APPROVED)
+    ).group_by(Category.id).all()
+
+
+def model_categories(db):
+    return db.query(
+        Category.id, Category.name, CategoryStats.product_count, CategoryStats.min_price, CategoryStats.max_price
+    ).outerjoin(CategoryStats, CategoryStats.category_id == Category.id).all()
+
+
+def live_search(db, category_id, low, high):
+    return db.query(Product, Category.name, User.business_name).join(
+        Category, Category.id == Product.category_id
+    ).join(User, User.id == Product.vendor_id).filter(
+        Product.status == ProductStatus.APPROVED,
+        Product.category_id == category_id,
+        Product.price.between(low, high)
+    ).all()
+
+
+def model_search(db, category_id, low, high):
+    return db.query(CatalogProduct).filter(
+        CatalogProduct.category_id == category_id,
+        CatalogProduct.price.between(low, high)
+    ).all()
+
+
+def timed(function, runs):
+    durations = []
+    for args in runs:
+        db = main.SessionLocal()
+        start = time.perf_counter()
+        function(db, *args)
+        durations.append(time.perf_counter() - start)
+        db.close()
+    return statistics.median(durations) * 1000
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=200000)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--vendors", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    workdir = tempfile.mkdtemp(prefix="bench-catalog-")
+    try:
+        main.init_engine(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+        main.prepare_schema("create")
+        start = time.perf_counter()
+        seed(args.products, args.categories, args.vendors)
+        print(f"seeded {args.products} products in {time.perf_counter() - start:.1f}s")
+
+        searches = [
+            (random.randint(1, args.categories), low, low + 50000)
+            for low in (random.randint(500, 400000) for _ in range(args.runs))
+        ]
+        db = main.SessionLocal()
+        assert sorted(map(tuple, live_categories(db))) == sorted(map(tuple, model_categories(db)))
+        assert len(live_search(db, *searches[0])) == len(model_search(db, *searches[0]))
+        db.close()
+
+        print(f"{'query':<22} {'live ms':>9} {'model ms':>9} {'speedup':>8}")
+        for name, live, model, runs in [
+            ("categories + stats", live_categories, model_categories, [()] * args.runs),
+            ("faceted search", live_search, model_search, searches),
+        ]:
+            live_ms, model_ms = timed(live, runs), timed(model, runs)
+            print(f"{name:<22} {live_ms:>9.2f} {model_ms:>9.2f} {live_ms / model_ms:>7.1f}x")
+
+        updates = []
+        for product_id in random.sample(range(1, args.products + 1), args.runs):
+            db = main.SessionLocal()
+            start = time.perf_counter()
+            db.query(Product).filter(Product.id == product_id).update({Product.price: random.randint(500, 500000)})
+            main.sync_catalog_product(db, product_id)
+            db.commit()
+            updates.append(time.perf_counter() - start)
+            db.close()
+        print(f"product update + read model sync: median {statistics.median(updates) * 1000:.2f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
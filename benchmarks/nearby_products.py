@@ -0,0 +1,136 @@
+"""Latency of the nearby-products lookup on a large synthetic vendor base.
+
+Usage:
+    python benchmarks/nearby_products.py --vendors 100000 --queries 50
+
+Vendors are spread uniformly over a country-sized area (Benin by default),
+each with a couple of approved products. The bounding-box lookup used by
+GET /products/nearby is compared with the naive approach: load every
+approved product with its vendor and compute the distance in Python.
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+LAT_RANGE = (6.2, 12.4)
+LON_RANGE = (0.8, 3.8)
+
+
+def seed(vendors: int, products_per_vendor: int):
+    db = main.SessionLocal()
+    category = main.Category(name="bench")
+    db.add(category)
+    db.commit()
+    batch = 10000
+    for start in range(0, vendors, batch):
+        db.execute(main.User.__table__.insert(), [
+            {
+                "email": f"vendor{i}@bench.test",
+                "username": f"vendor{i}",
+                "hashed_password": "-",
+                "role": main.UserRole.VENDOR.name,
+                "is_active": True,
+                "is_verified": True,
+                "latitude": random.uniform(*LAT_RANGE),
+                "longitude": random.uniform(*LON_RANGE),
+            }
+            for i in range(start, min(start + batch, vendors))
+        ])
+    vendor_ids = [row[0] for row in db.query(main.User.id)]
+    rows = [
+        {
+            "name": f"Product {vendor_id}-{j}",
+            "price": 1000 + j,
+            "stock": 10,
+            "status": main.ProductStatus.APPROVED.name,
+            "category_id": category.id,
+            "vendor_id": vendor_id,
+        }
+        for vendor_id in vendor_ids
+        for j in range(products_per_vendor)
+    ]
+    for start in range(0, len(rows), batch):
+        db.execute(main.Product.__table__.insert(), rows[start:start + batch])
+    db.commit()
+    db.close()
+
+
+def naive_nearby(db, latitude, longitude, radius_km, limit, offset):
+    rows = db.query(main.Product, main.User.latitude, main.User.longitude).join(
+        main.User, main.Product.vendor_id == main.User.id
+    ).filter(main.Product.status == main.ProductStatus.APPROVED).all()
+    found = []
+    for product, vendor_latitude, vendor_longitude in rows:
+        if vendor_latitude is None or vendor_longitude is None:
+            continue
+        distance = main.calculate_distance(latitude, longitude, vendor_latitude, vendor_longitude)
+        if distance <= radius_km:
+            found.append((product, distance))
+    found.sort(key=lambda item: (item[1], item[0].id))
+    return found[offset:offset + limit]
+
+
+def timed(function, points, radius_km, limit):
+    durations = []
+    results = []
+    for latitude, longitude in points:
+        db = main.SessionLocal()
+        start = time.perf_counter()
+        results.append([product.id for product, _ in function(db, latitude, longitude, radius_km, limit, 0)])
+        durations.append(time.perf_counter() - start)
+        db.close()
+    return durations, results
+
+
+def describe(name, durations):
+    values = sorted(d * 1000 for d in durations)
+    p95 = values[max(int(len(values) * 0.95) - 1, 0)]
+    print(f"{name:<14} median {statistics.median(values):9.2f} ms   p95 {p95:9.2f} ms")
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vendors", type=int, default=100000)
+    parser.add_argument("--products-per-vendor", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--naive-queries", type=int, default=3)
+    parser.add_argument("--radius-km", type=float, default=5)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    workdir = tempfile.mkdtemp(prefix="bench-nearby-")
+    try:
+        main.init_engine(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+        main.prepare_schema("create")
+        start = time.perf_counter()
+        seed(args.vendors, args.products_per_vendor)
+        print(f"seeded {args.vendors} vendors / {args.vendors * args.products_per_vendor} products "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        points = [(random.uniform(*LAT_RANGE), random.uniform(*LON_RANGE)) for _ in range(args.queries)]
+        box_durations, box_results = timed(main.find_nearby_products, points, args.radius_km, args.limit)
+        naive_points = points[:args.naive_queries]
+        naive_durations, naive_results = timed(naive_nearby, naive_points, args.radius_km, args.limit)
+        assert naive_results == box_results[:len(naive_results)], "bounding-box results differ from naive scan"
+
+        print(f"radius={args.radius_km} km  limit={args.limit}")
+        describe("bounding box", box_durations)
+        describe("naive scan", naive_durations)
+        print(f"speedup        {statistics.median(naive_durations) / statistics.median(box_durations):9.1f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,87 @@
+"""Distance and planning time of batched delivery routes versus one trip per order.
+
+Usage:
+    python benchmarks/route_planner.py --orders 10 50 200 --drivers 20
+
+Orders are generated over a city-sized area (Cotonou by default) with
+vendors clustered around a few markets. For each order count three
+strategies are compared on the total distance driven:
+- single: every order is its own trip, from the closest driver
+- batched (nn): orders grouped by group_orders, stops in nearest-neighbour order
+- batched (nn+2opt): same batches, stops improved with 2-opt
+Planning time covers grouping and stop ordering, as done by the
+assign_delivery job.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+LAT_RANGE = (6.33, 6.45)
+LON_RANGE = (2.30, 2.50)
+MARKETS = 6
+
+
+def generate(orders: int, drivers: int):
+    markets = [(random.uniform(*LAT_RANGE), random.uniform(*LON_RANGE)) for _ in range(MARKETS)]
+    generated = []
+    for order_id in range(orders):
+        market = random.choice(markets)
+        vendor = (market[0] + random.gauss(0, 0.005), market[1] + random.gauss(0, 0.005))
+        client = (random.uniform(*LAT_RANGE), random.uniform(*LON_RANGE))
+        generated.append((order_id, vendor, client))
+    positions = [(random.uniform(*LAT_RANGE), random.uniform(*LON_RANGE)) for _ in range(drivers)]
+    return generated, positions
+
+
+def closest(positions, point):
+    return min(positions, key=lambda p: main.calculate_distance(p[0], p[1], point[0], point[1]))
+
+
+def plan(orders, positions, max_orders: int, optimize: bool):
+    total = 0.0
+    routes = 0
+    start = time.perf_counter()
+    for batch in main.group_orders(orders, max_orders=max_orders):
+        driver = closest(positions, batch[0][1])
+        _, length = main.plan_route(driver, [o[1] for o in batch], [o[2] for o in batch], optimize=optimize)
+        total += length
+        routes += 1
+    return total, routes, time.perf_counter() - start
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--max-orders", type=int, default=main.ROUTE_MAX_ORDERS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(42)
+    print(f"{'orders':>6} {'strategy':<18} {'routes':>7} {'km':>9} {'vs single':>9} {'plan ms':>9}")
+    for count in args.orders:
+        results = {"single": [], "batched (nn)": [], "batched (nn+2opt)": []}
+        for _ in range(args.runs):
+            orders, positions = generate(count, args.drivers)
+            results["single"].append(plan(orders, positions, 1, False))
+            results["batched (nn)"].append(plan(orders, positions, args.max_orders, False))
+            results["batched (nn+2opt)"].append(plan(orders, positions, args.max_orders, True))
+        single_km = statistics.mean(r[0] for r in results["single"])
+        for name, runs in results.items():
+            km = statistics.mean(r[0] for r in runs)
+            print(
+                f"{count:>6} {name:<18} {statistics.mean(r[1] for r in runs):>7.1f} {km:>9.1f} "
+                f"{km / single_km:>8.2f}x {statistics.median(r[2] for r in runs) * 1000:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main_()
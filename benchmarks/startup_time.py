@@ -0,0 +1,93 @@
+"""Cold-start latency of the API: module import and process start to first served request.
+
+Usage:
+    python benchmarks/startup_time.py --runs 5
+
+For each run a fresh interpreter is used, so nothing is cached in memory:
+- import: time to `import main` (must not touch the database)
+- first request: time from spawning `uvicorn main:create_app --factory`
+  to the first 200 response of GET /products (engine creation, schema
+  check, pool warm-up and the first catalog query included)
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def measure_import(env: dict) -> float:
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def measure_first_request(env: dict, port: int, timeout: float = 60) -> float:
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:create_app", "--factory", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/products", timeout=1).status_code == 200:
+                    return time.perf_counter() - start
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("API did not answer in time")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def summary(values) -> str:
+    values = [v * 1000 for v in values]
+    return f"min {min(values):8.1f} ms   median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--schema-mode", default="create", choices=["create", "check", "none"])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    env = dict(
+        os.environ,
+        SQLALCHEMY_DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        SECRET_KEY="benchmark-secret-key-benchmark-secret",
+        DB_SCHEMA_MODE=args.schema_mode,
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    try:
+        # First start creates the schema so that every measured run sees the same database
+        measure_first_request(dict(env, DB_SCHEMA_MODE="create"), args.port)
+        imports = [measure_import(env) for _ in range(args.runs)]
+        first_requests = [measure_first_request(env, args.port) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"runs={args.runs} schema_mode={args.schema_mode}")
+    print(f"import main      {summary(imports)}")
+    print(f"first request    {summary(first_requests)}")
+
+
+if __name__ == "__main__":
+    main()
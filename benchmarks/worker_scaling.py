@@ -0,0 +1,195 @@
+"""Throughput of the API for an increasing number of uvicorn workers.
+
+Usage:
+    python benchmarks/worker_scaling.py --workers 1 2 4 --duration 10
+
+Each run starts `uvicorn main:create_app --factory` with N workers on a fresh SQLite database
+seeded with a small catalog, then hammers read endpoints from several
+client processes and reports requests/second and latency percentiles.
+The /metrics endpoint is scraped at the end to check that counters from
+every worker are aggregated (PROMETHEUS_MULTIPROC_DIR).
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROM_USERNAME = "bench"
+PROM_PASSWORD = "bench"
+
+
+def seed(database_url: str, products: int):
+    sys.path.insert(0, ROOT)
+    import main
+
+    main.init_engine(database_url)
+    main.prepare_schema("create")
+    db = main.SessionLocal()
+    vendor = main.User(
+        email="bench_vendor@test.com",
+        username="bench_vendor",
+        hashed_password="-",
+        role=main.UserRole.VENDOR,
+        is_verified=True,
+    )
+    category = main.Category(name="bench")
+    db.add_all([vendor, category])
+    db.commit()
+    db.add_all([
+        main.Product(
+            name=f"Product {i}",
+            description="Benchmark product " * 4,
+            price=1000 + i,
+            stock=100,
+            status=main.ProductStatus.APPROVED,
+            category_id=category.id,
+            vendor_id=vendor.id,
+        )
+        for i in range(products)
+    ])
+    db.commit()
+    db.close()
+
+
+def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("API did not start in time")
+
+
+def client(base_url: str, products: int, duration: float, results):
+    session = requests.Session()
+    latencies = []
+    deadline = time.time() + duration
+    i = 0
+    try:
+        while time.time() < deadline:
+            i += 1
+            path = "/products" if i % 10 == 0 else f"/products/{i % products + 1}"
+            start = time.perf_counter()
+            response = session.get(base_url + path, timeout=10)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} returned {response.status_code}")
+    except Exception as exc:
+        # Reported to the parent, which waits for one result per client
+        results.put(RuntimeError(f"client failed: {exc!r}"))
+        return
+    results.put(latencies)
+
+
+def run(workers: int, clients: int, duration: float, products: int, port: int) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-workers-")
+    metrics_dir = os.path.join(workdir, "prometheus")
+    os.makedirs(metrics_dir)
+    database_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    seed_process = multiprocessing.Process(target=seed, args=(database_url, products))
+    seed_process.start()
+    seed_process.join()
+
+    env = dict(
+        os.environ,
+        SQLALCHEMY_DATABASE_URL=database_url,
+        SECRET_KEY="benchmark-secret-key-benchmark-secret",
+        PROMETHEUS_MULTIPROC_DIR=metrics_dir,
+        PROM_USERNAME=PROM_USERNAME,
+        PROM_PASSWORD=PROM_PASSWORD,
+        WEB_CONCURRENCY=str(workers),
+        # Every client shares the loopback IP: per-IP rate limits would throttle the benchmark itself
+        RATE_LIMIT_ENABLED="false",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:create_app", "--factory", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    processes = []
+    try:
+        wait_ready(base_url)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=client, args=(base_url, products, duration, results))
+            for _ in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        latencies = []
+        for _ in processes:
+            try:
+                result = results.get(timeout=duration + 60)
+            except queue.Empty:
+                exit_codes = [process.exitcode for process in processes]
+                raise RuntimeError(f"clients did not report their results (exit codes: {exit_codes})") from None
+            if isinstance(result, Exception):
+                raise result
+            latencies.extend(result)
+        for process in processes:
+            process.join()
+
+        metrics = requests.get(f"{base_url}/metrics", auth=(PROM_USERNAME, PROM_PASSWORD), timeout=10)
+        counted = sum(
+            float(line.rsplit(" ", 1)[1])
+            for line in metrics.text.splitlines()
+            if line.startswith("http_requests_total{") and 'path="/products' in line
+        )
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "rps": len(latencies) / duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "metrics_requests": int(counted),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=2 * (os.cpu_count() or 1))
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"cpus={os.cpu_count()} clients={args.clients} duration={args.duration}s")
+    print(f"{'workers':>7} {'requests':>9} {'req/s':>9} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'/metrics':>9}")
+    baseline = None
+    for workers in args.workers:
+        result = run(workers, args.clients, args.duration, args.products, args.port)
+        baseline = baseline or result["rps"]
+        print(
+            f"{result['workers']:>7} {result['requests']:>9} {result['rps']:>9.1f} "
+            f"{result['rps'] / baseline:>7.2f}x {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+            f"{result['metrics_requests']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
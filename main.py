@@ -1,21 +1,40 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect, Header, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, HTTPBasic, HTTPBasicCredentials
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy import create_engine, make_url, inspect, select, insert, update, delete, func, or_, and_, MetaData, Table, Index, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Enum as SQLEnum
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
-from passlib.context import CryptContext
-import jwt
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.event import listens_for
+from sqlalchemy.exc import IntegrityError, OperationalError
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List
-from pydantic import BaseModel, EmailStr, ConfigDict
+from typing import Optional, List, NamedTuple
+from pydantic import BaseModel, EmailStr, ConfigDict, Field, AwareDatetime
 import enum
+from functools import lru_cache
 import os
 from dotenv import load_dotenv
-from math import radians, cos, sin, asin, sqrt
+import jwt
+from math import radians, degrees, cos, sin, asin, sqrt
 from prometheus_fastapi_instrumentator import Instrumentator
-from prometheus_client import Counter, Histogram
-
-import logging, uuid, json, time, secrets
+from prometheus_client import Counter, Histogram, Gauge, multiprocess
+from pydantic import TypeAdapter
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+
+import logging, uuid, json, time, secrets, gzip, threading, asyncio, random, hashlib, glob, re, io, csv, ipaddress
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # optional: Content-Encoding br
+    brotli = None
+
+try:
+    from compression import zstd  # Python >= 3.14
+except ImportError:
+    zstd = None
 
 load_dotenv()
 
@@ -33,14 +52,23 @@ SECRET_KEY = os.environ.get("SECRET_KEY", None)
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Database setup
+# Database setup (the engine is created by init_engine at application startup)
 SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL", None)
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_SCHEMA_MODE = os.environ.get("DB_SCHEMA_MODE", "create")  # create | check | none
+DB_POOL_WARMUP = int(os.environ.get("DB_POOL_WARMUP", "2"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+engine = None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    # passlib and its bcrypt backend are only loaded on the first login
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Enums
@@ -63,6 +91,16 @@ class OrderStatus(str, enum.Enum):
     DELIVERED = "delivered"
     CANCELLED = "cancelled"
 
+class StopKind(str, enum.Enum):
+    PICKUP = "pickup"
+    DROPOFF = "dropoff"
+
+class JobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
 # ==================== MODELS ====================
 class User(Base):
     __tablename__ = "users"
@@ -84,8 +122,12 @@ class User(Base):
     is_verified = Column(Boolean, default=False)
     
     # Relations
-    products = relationship("Product", back_populates="vendor")
-    deliveries = relationship("Order", back_populates="delivery_person")
+    # Deleting a user never loads these: references are detached in batches (see CASCADING DELETES)
+    products = relationship("Product", back_populates="vendor", passive_deletes="all")
+    deliveries = relationship("Order", back_populates="delivery_person", passive_deletes="all")
+    
+    # Bounding-box lookups of nearby vendors
+    __table_args__ = (Index("ix_users_latitude_longitude", "latitude", "longitude"),)
 
 class Category(Base):
     __tablename__ = "categories"
@@ -95,7 +137,7 @@ class Category(Base):
     description = Column(String)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     
-    products = relationship("Product", back_populates="category")
+    products = relationship("Product", back_populates="category", passive_deletes="all")
 
 class Product(Base):
     __tablename__ = "products"
@@ -109,8 +151,8 @@ class Product(Base):
     status = Column(SQLEnum(ProductStatus), default=ProductStatus.PENDING)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     
-    category_id = Column(Integer, ForeignKey("categories.id"))
-    vendor_id = Column(Integer, ForeignKey("users.id"))
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="SET NULL"), index=True)
+    vendor_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), index=True)
     
     category = relationship("Category", back_populates="products")
     vendor = relationship("User", back_populates="products")
@@ -135,7 +177,7 @@ class Order(Base):
     status = Column(SQLEnum(OrderStatus), default=OrderStatus.PENDING)
     payment_reference = Column(String)  # Fedapay reference
     
-    delivery_person_id = Column(Integer, ForeignKey("users.id"))
+    delivery_person_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     paid_at = Column(DateTime)
     delivered_at = Column(DateTime)
@@ -166,8 +208,153 @@ class CartItem(Base):
     
     product = relationship("Product", back_populates="cart_items")
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+class CatalogProduct(Base):
+    __tablename__ = "catalog_products"
+    
+    # Read model: approved products flattened with their category and vendor names
+    id = Column(Integer, primary_key=True, autoincrement=False)  # products.id
+    name = Column(String, nullable=False)
+    description = Column(String)
+    price = Column(Float, nullable=False)
+    stock = Column(Integer)
+    image_url = Column(String)
+    category_id = Column(Integer, index=True)
+    category_name = Column(String)
+    vendor_id = Column(Integer, index=True)
+    vendor_name = Column(String)
+    
+    __table_args__ = (Index("ix_catalog_products_category_id_price", "category_id", "price"),)
+
+class CategoryStats(Base):
+    __tablename__ = "category_stats"
+    
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), primary_key=True)
+    product_count = Column(Integer, nullable=False, default=0)
+    min_price = Column(Float)
+    max_price = Column(Float)
+
+class StockReservation(Base):
+    __tablename__ = "stock_reservations"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String, index=True, nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), index=True, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)  # set at checkout
+    expires_at = Column(DateTime, nullable=False, index=True)  # UTC
+
+class StockShard(Base):
+    __tablename__ = "stock_shards"
+    
+    # Available stock of a hot product split over several rows
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    stock = Column(Integer, nullable=False)
+
+class DeliveryRoute(Base):
+    __tablename__ = "delivery_routes"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    delivery_person_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), index=True)
+    total_distance_km = Column(Float, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    
+    stops = relationship("RouteStop", back_populates="route", order_by="RouteStop.sequence")
+
+class RouteStop(Base):
+    __tablename__ = "route_stops"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    route_id = Column(Integer, ForeignKey("delivery_routes.id"), index=True, nullable=False)
+    sequence = Column(Integer, nullable=False)
+    kind = Column(SQLEnum(StopKind), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True, nullable=False)
+    vendor_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))  # pickups only
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    
+    route = relationship("DeliveryRoute", back_populates="stops")
+
+class CatalogVersion(Base):
+    __tablename__ = "catalog_version"
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class Job(Base):
+    __tablename__ = "jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(String, nullable=False)  # JSON
+    status = Column(SQLEnum(JobStatus), default=JobStatus.PENDING, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    last_error = Column(String)
+    run_at = Column(DateTime, nullable=False, index=True)  # UTC
+    locked_at = Column(DateTime)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, unique=True, nullable=False)
+    fingerprint = Column(String, nullable=False)  # sha256 of method, path and query
+    response_status = Column(Integer, nullable=False)
+    response_body = Column(String, nullable=False)  # JSON
+    created_at = Column(DateTime, nullable=False, index=True)  # UTC
+
+# ==================== DATABASE ====================
+def init_engine(database_url: Optional[str] = None):
+    """Créer l'engine (une fois par processus) et y lier SessionLocal"""
+    global engine
+    if engine is None:
+        url = make_url(database_url or SQLALCHEMY_DATABASE_URL)
+        pool_options = {}
+        if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+            # In-memory SQLite uses a single shared connection and rejects pool sizing
+            pool_options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+        engine = create_engine(url, connect_args={"check_same_thread": False}, **pool_options)
+        SessionLocal.configure(bind=engine)
+    return engine
+
+SCHEMA_CREATE_ATTEMPTS = 10
+
+def prepare_schema(mode: str = DB_SCHEMA_MODE):
+    """Créer les tables manquantes (create), vérifier leur présence (check) ou ne rien faire (none)"""
+    if mode == "create":
+        for attempt in range(SCHEMA_CREATE_ATTEMPTS):
+            try:
+                Base.metadata.create_all(bind=engine)
+                break
+            except OperationalError:
+                # Another worker created some tables concurrently: the next pass skips them
+                if attempt == SCHEMA_CREATE_ATTEMPTS - 1:
+                    raise
+        # create_all skips existing tables: add indexes declared after their creation
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(bind=engine, checkfirst=True)
+                except OperationalError:
+                    pass  # created concurrently by another worker
+        try:
+            refresh_history_views()
+        except OperationalError:
+            pass  # replaced concurrently by another worker
+    elif mode == "check":
+        missing = set(Base.metadata.tables) - set(inspect(engine).get_table_names())
+        if missing:
+            raise RuntimeError(f"Missing database tables: {', '.join(sorted(missing))}")
+
+def warm_up_pool(size: int = DB_POOL_WARMUP):
+    """Ouvrir les premières connexions avant la première requête"""
+    connections = [engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.exec_driver_sql("SELECT 1")
+        connection.close()
 
 # ==================== SCHEMAS ====================
 class Token(BaseModel):
@@ -209,6 +396,11 @@ class CategoryResponse(BaseModel):
     
     model_config = ConfigDict(from_attributes=True)
 
+class CategoryStatsResponse(CategoryResponse):
+    product_count: int
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+
 class ProductCreate(BaseModel):
     name: str
     description: Optional[str] = None
@@ -232,14 +424,22 @@ class ProductResponse(BaseModel):
     price: float
     stock: int
     status: ProductStatus
-    category_id: int
-    vendor_id: int
+    category_id: Optional[int] = None  # None once the category or vendor is deleted
+    vendor_id: Optional[int] = None
     
     model_config = ConfigDict(from_attributes=True)
 
+class CatalogProductResponse(ProductResponse):
+    status: ProductStatus = ProductStatus.APPROVED
+    category_name: Optional[str] = None
+    vendor_name: Optional[str] = None
+
+class NearbyProductResponse(ProductResponse):
+    distance_km: float
+
 class CartItemCreate(BaseModel):
     product_id: int
-    quantity: int
+    quantity: int = Field(gt=0)
 
 class CartItemResponse(BaseModel):
     id: int
@@ -258,6 +458,31 @@ class OrderCreate(BaseModel):
     client_latitude: float
     client_longitude: float
 
+class LocationUpdate(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+class LocationPoint(LocationUpdate):
+    # A time without offset would be read in the server's local time zone
+    recorded_at: Optional[AwareDatetime] = None
+
+class LocationBatch(BaseModel):
+    points: List[LocationPoint] = Field(min_length=1, max_length=100)
+
+class JobResponse(BaseModel):
+    id: int
+    kind: str
+    payload: str
+    status: JobStatus
+    attempts: int
+    max_attempts: int
+    last_error: Optional[str] = None
+    run_at: datetime
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    
+    model_config = ConfigDict(from_attributes=True)
+
 class OrderResponse(BaseModel):
     id: int
     order_number: str
@@ -277,10 +502,10 @@ def get_db():
         db.close()
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -292,24 +517,26 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def get_user_from_token(token: str, db: Session) -> Optional[User]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         role: str = payload.get("role")
         if username is None:
-            raise credentials_exception
+            return None
         token_data = TokenData(username=username, role=role)
     except Exception:
-        raise credentials_exception
-    user = db.query(User).filter(User.username == token_data.username).first()
+        return None
+    return db.query(User).filter(User.username == token_data.username).first()
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    user = get_user_from_token(token, db)
     if user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 def get_admin_user(current_user: User = Depends(get_current_user)):
@@ -322,6 +549,15 @@ def get_vendor_user(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Vendor privileges required")
     return current_user
 
+def bounding_box(latitude, longitude, radius_km):
+    """Rectangle (lat_min, lat_max, lon_min, lon_max) contenant le cercle de rayon radius_km"""
+    delta_lat = degrees(radius_km / 6371)
+    lat_min, lat_max = latitude - delta_lat, latitude + delta_lat
+    if lat_min <= -90 or lat_max >= 90:
+        return max(lat_min, -90), min(lat_max, 90), -180, 180
+    delta_lon = degrees(asin(min(1, sin(radius_km / 6371) / cos(radians(latitude)))))
+    return lat_min, lat_max, longitude - delta_lon, longitude + delta_lon
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two GPS coordinates using Haversine formula (in km)"""
     lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
@@ -333,11 +569,29 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     return km
 
 # ==================== APP ====================
-app = FastAPI(
-    title="E-commerce API",
-    description="API REST pour plateforme e-commerce avec vendeurs, livreurs et admins",
-    version="1.0.0"
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_engine()
+    await run_in_threadpool(prepare_schema)
+    await run_in_threadpool(warm_up_pool)
+    cleanup_dead_workers_metrics()
+    await run_in_threadpool(ensure_catalog_version)
+    await run_in_threadpool(ensure_catalog_read_model)
+    tasks = [asyncio.create_task(location_flush_loop())]
+    tasks.append(asyncio.create_task(inventory_sweep_loop()))
+    if ORDER_ARCHIVE_AFTER_DAYS > 0:
+        tasks.append(asyncio.create_task(order_archive_loop()))
+    tasks += [asyncio.create_task(job_worker_loop()) for _ in range(JOB_WORKERS)]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await run_in_threadpool(flush_driver_locations)
+        if PROMETHEUS_MULTIPROC_DIR:
+            multiprocess.mark_process_dead(os.getpid(), PROMETHEUS_MULTIPROC_DIR)
+
+router = APIRouter()
 
 
 
@@ -354,7 +608,380 @@ HTTP_REQUEST_DURATION_MS = Histogram(
     buckets=[10, 50, 100, 300, 500, 1000, 2000, 5000]
 )
 
-@app.middleware("http")
+# ==================== COMPRESSION ====================
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "500"))
+
+COMPRESSORS = {
+    "gzip": lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=5)
+if zstd is not None:
+    COMPRESSORS["zstd"] = lambda data: zstd.compress(data, level=3)
+
+# Server side preference when the client accepts several encodings with the same weight
+ENCODING_PREFERENCE = [name for name in ("zstd", "br", "gzip") if name in COMPRESSORS]
+
+COMPRESSED_BYTES_SAVED = Counter(
+    "http_compression_bytes_saved_total",
+    "Response bytes saved by compression",
+    ["encoding"]
+)
+
+COMPRESSION_DURATION_MS = Histogram(
+    "http_compression_duration_ms",
+    "Time spent compressing a response body in milliseconds",
+    ["encoding"],
+    buckets=[0.1, 0.5, 1, 2, 5, 10, 25, 50, 100]
+)
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Choisir le meilleur encodage supporté à partir du header Accept-Encoding"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            weights[name] = quality
+    wildcard = weights.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for name in ENCODING_PREFERENCE:
+        quality = weights.get(name, wildcard)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    start_time = time.perf_counter()
+    compressed = COMPRESSORS[encoding](data)
+    COMPRESSION_DURATION_MS.labels(encoding=encoding).observe(
+        (time.perf_counter() - start_time) * 1000
+    )
+    return compressed
+
+class CompressionMiddleware:
+    """Compression gzip/br/zstd négociée des réponses non streamées"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+            # Streaming responses and already encoded payloads are sent as is
+            if (
+                message.get("more_body", False)
+                or "content-encoding" in headers
+                or len(body) < self.minimum_size
+            ):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = compress_body(body, encoding)
+            if len(compressed) >= len(body):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            COMPRESSED_BYTES_SAVED.labels(encoding=encoding).inc(len(body) - len(compressed))
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+# ==================== RATE LIMITING ====================
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL", None)
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", "0"))  # 0: capacity of the connection pool
+# Load balancers / ingress allowed to set X-Forwarded-For (comma-separated IPs or CIDRs)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get("TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+
+class RateLimitPolicy(NamedTuple):
+    name: str
+    method: Optional[str]
+    path: Optional[re.Pattern]
+    rate: float  # tokens added per second
+    burst: int  # bucket capacity
+    key: str  # ip | session | user
+    ip_rate: Optional[float] = None  # client-chosen keys: per-IP bucket charged as well
+    ip_burst: int = 0
+
+# First matching policy applies
+RATE_LIMIT_POLICIES = [
+    RateLimitPolicy("login", "POST", re.compile(r"^/token$"), 5 / 60, 5, "ip"),
+    RateLimitPolicy("register", "POST", re.compile(r"^/register/"), 5 / 60, 5, "ip"),
+    RateLimitPolicy("orders", "POST", re.compile(r"^/orders$"), 10 / 60, 5, "ip"),
+    RateLimitPolicy("payment", "POST", re.compile(r"^/orders/\d+/payment$"), 10 / 60, 10, "ip"),
+    RateLimitPolicy("cart", None, re.compile(r"^/cart"), 2, 30, "session", ip_rate=20, ip_burst=200),
+    RateLimitPolicy("location", "POST", re.compile(r"^/delivery/location$"), 1, 10, "user"),
+    RateLimitPolicy("default", None, None, 20, 100, "ip"),
+]
+
+# Long-lived connections do not count as in-flight requests
+IN_FLIGHT_EXCLUDED_PATHS = re.compile(r"^/metrics$|^/orders/\d+/events$")
+
+RATE_LIMITED_REQUESTS = Counter(
+    "rate_limited_requests_total",
+    "Requests rejected with 429 by the rate limiter",
+    ["policy"]
+)
+
+LOAD_SHED_REQUESTS = Counter(
+    "load_shed_requests_total",
+    "Requests rejected with 503 because too many requests were in flight"
+)
+
+IN_FLIGHT_REQUESTS = Gauge(
+    "in_flight_requests",
+    "Requests currently being processed (admission control)",
+    multiprocess_mode="livesum"
+)
+
+class MemoryTokenBucketStore:
+    """Token buckets en mémoire : O(1) par clé active, éviction LRU au-delà de max_keys"""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def hit(self, key: str, rate: float, burst: int) -> float:
+        """Consommer un jeton ; retourne 0 si autorisé, sinon le délai d'attente en secondes"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+class RedisTokenBucketStore:
+    """Token buckets partagés entre workers/instances dans un serveur compatible Redis"""
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio  # optional dependency, only needed with RATE_LIMIT_REDIS_URL
+        self._client = redis.asyncio.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    async def hit(self, key: str, rate: float, burst: int) -> float:
+        try:
+            result = await self._script(keys=[f"ratelimit:{key}"], args=[rate, burst, time.time()])
+        except Exception:
+            # Fail open: an unavailable limiter must not take the API down
+            logger.exception("Rate limit store unavailable")
+            return 0.0
+        return float(result)
+
+def token_subject(token: str) -> Optional[str]:
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except Exception:
+        return None
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def get_client_ip(request: Request) -> str:
+    """IP du client : celle de la connexion, ou celle transmise par X-Forwarded-For si la connexion vient d'un proxy de confiance"""
+    peer = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    # Each proxy appends the address it received the request from: the last untrusted hop is the client
+    for hop in reversed(hops):
+        try:
+            ipaddress.ip_address(hop)
+        except ValueError:
+            # A malformed header cannot be attributed to anyone: fall back to the proxy itself
+            return peer
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+def rate_limit_key(policy: RateLimitPolicy, request: Request) -> str:
+    client_ip = get_client_ip(request)
+    if policy.key == "session":
+        session_id = request.query_params.get("session_id")
+        if session_id is None and request.url.path.startswith("/cart/"):
+            session_id = request.url.path.split("/")[2]
+        if session_id:
+            return f"{policy.name}:session:{session_id}"
+    elif policy.key == "user":
+        authorization = request.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            subject = token_subject(authorization[7:])
+            if subject:
+                return f"{policy.name}:user:{subject}"
+    return f"{policy.name}:ip:{client_ip}"
+
+def background_connections() -> int:
+    """Connexions que les tâches de fond peuvent garder ouvertes en même temps que les requêtes"""
+    loops = JOB_WORKERS + 2  # job workers, reservation sweep, location flush
+    if ORDER_ARCHIVE_AFTER_DAYS > 0:
+        loops += 1
+    # detach_references opens a second session next to the request's own
+    return loops + 1
+
+def pool_capacity() -> Optional[int]:
+    """Connexions du pool disponibles pour les requêtes (taille + débordement - tâches de fond), None si illimité"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return None  # no checkout queue: requests never wait for a connection
+    if DB_MAX_OVERFLOW < 0:
+        return None
+    return max(1, pool.size() + DB_MAX_OVERFLOW - background_connections())
+
+def rate_limit_buckets(policy: RateLimitPolicy, request: Request) -> list:
+    """Buckets (clé, politique) à débiter pour une requête"""
+    buckets = [(rate_limit_key(policy, request), policy)]
+    if policy.ip_rate:
+        # A client rotating its session_id still shares one bucket per IP
+        ip_policy = policy._replace(name=f"{policy.name}_ip", key="ip", rate=policy.ip_rate, burst=policy.ip_burst)
+        buckets.append((rate_limit_key(ip_policy, request), ip_policy))
+    return buckets
+
+def find_rate_limit_policy(method: str, path: str) -> Optional[RateLimitPolicy]:
+    for policy in RATE_LIMIT_POLICIES:
+        if policy.method and policy.method != method:
+            continue
+        if policy.path and not policy.path.search(path):
+            continue
+        return policy
+    return None
+
+class AdmissionControlMiddleware:
+    """Limitation de débit par client (429) et délestage au-delà de MAX_IN_FLIGHT_REQUESTS (503)"""
+
+    def __init__(self, app, store=None, max_in_flight: int = MAX_IN_FLIGHT_REQUESTS):
+        self.app = app
+        if store is None:
+            store = RedisTokenBucketStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryTokenBucketStore()
+        self.store = store
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    def in_flight_limit(self) -> Optional[int]:
+        if not self.max_in_flight:
+            # Read once the engine exists: admitted requests do not queue behind the background loops
+            self.max_in_flight = pool_capacity()
+        return self.max_in_flight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        policy = find_rate_limit_policy(request.method, request.url.path)
+        if policy is not None:
+            retry_after, limited_by = 0.0, None
+            for key, bucket_policy in rate_limit_buckets(policy, request):
+                wait = await self.store.hit(key, bucket_policy.rate, bucket_policy.burst)
+                if wait > retry_after:
+                    retry_after, limited_by = wait, bucket_policy.name
+            if retry_after > 0:
+                RATE_LIMITED_REQUESTS.labels(policy=limited_by).inc()
+                response = JSONResponse(
+                    status_code=429,
+                    content={"detail": "Too many requests"},
+                    headers={"Retry-After": str(max(1, round(retry_after)))}
+                )
+                await response(scope, receive, send)
+                return
+
+        if IN_FLIGHT_EXCLUDED_PATHS.search(request.url.path):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.in_flight_limit()
+        if limit is not None and self.in_flight >= limit:
+            LOAD_SHED_REQUESTS.inc()
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server busy, retry later"},
+                headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+
+        self.in_flight += 1
+        IN_FLIGHT_REQUESTS.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            IN_FLIGHT_REQUESTS.dec()
+
 async def request_logging_middleware(request: Request, call_next):
     start_time = time.time()
     request_id = str(uuid.uuid4())
@@ -383,7 +1010,7 @@ async def request_logging_middleware(request: Request, call_next):
         "path": request.url.path,
         "status_code": response.status_code,
         "duration_ms": duration_ms,
-        "client_ip": request.client.host if request.client else None,
+        "client_ip": get_client_ip(request) if request.client else None,
         "user_agent": request.headers.get("user-agent"),
     }
 
@@ -394,6 +1021,27 @@ async def request_logging_middleware(request: Request, call_next):
 
 
 
+# Set when running several workers: metrics are then aggregated by the /metrics endpoint
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", None)
+
+def pid_is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def cleanup_dead_workers_metrics():
+    """Retirer les gauges 'live' laissées par des workers arrêtés brutalement"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "gauge_live*_*.db")):
+        pid = os.path.basename(path)[:-len(".db")].rsplit("_", 1)[1]
+        if pid.isdigit() and int(pid) != os.getpid() and not pid_is_running(int(pid)):
+            multiprocess.mark_process_dead(int(pid), PROMETHEUS_MULTIPROC_DIR)
+
 PROM_USERNAME = os.environ.get("PROM_USERNAME", None)
 PROM_PASSWORD = os.environ.get("PROM_PASSWORD", None)
 
@@ -412,25 +1060,6 @@ async def basic_auth(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
     return True
 
 
-instrumentator = Instrumentator(
-    should_group_status_codes=False,
-    should_ignore_untemplated=True,
-    should_respect_env_var=False,
-    should_instrument_requests_inprogress=True,
-    excluded_handlers=["/metrics"],
-    inprogress_name="inprogress",
-    inprogress_labels=True
-)
-
-instrumentator.instrument(app)
-
-instrumentator.expose(
-    app,
-    endpoint="/metrics",
-    dependencies=[Depends(basic_auth)]
-)
-
-
 
 ORDERS_CREATED = Counter(
     "orders_created_total",
@@ -453,8 +1082,1143 @@ LOGIN_FAILURES = Counter(
     "Total failed login attempts"
 )
 
+# ==================== CATALOG CACHE ====================
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get("CATALOG_CACHE_MAX_ENTRIES", "1024"))
+
+CATALOG_CACHE_REQUESTS = Counter(
+    "catalog_cache_requests_total",
+    "Catalog list requests served from the precomputed cache",
+    ["result"]
+)
+
+CATEGORY_LIST_ADAPTER = TypeAdapter(List[CategoryStatsResponse])
+PRODUCT_LIST_ADAPTER = TypeAdapter(List[CatalogProductResponse])
+
+def ensure_catalog_version():
+    db = SessionLocal()
+    try:
+        if db.get(CatalogVersion, 1) is None:
+            db.add(CatalogVersion(id=1, version=0))
+            db.commit()
+    except IntegrityError:
+        db.rollback()  # created by another worker
+    finally:
+        db.close()
+
+class CatalogCache:
+    """Réponses du catalogue sérialisées et précompressées, par version du catalogue
+
+    La version est stockée en base pour que tous les workers invalident
+    leur cache dès qu'un seul d'entre eux modifie le catalogue.
+    """
+
+    def __init__(self, max_entries: int = CATALOG_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, db: Session):
+        """Incrémenter la version du catalogue dans la transaction de l'appelant"""
+        bumped = db.query(CatalogVersion).filter(CatalogVersion.id == 1).update(
+            {CatalogVersion.version: CatalogVersion.version + 1},
+            synchronize_session=False
+        )
+        if not bumped:
+            # Row missing (tables recreated after startup)
+            db.add(CatalogVersion(id=1, version=1))
+
+    def get(self, db: Session, key, build):
+        version = db.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar()
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+            entry = self._entries.get(key)
+        if entry is not None:
+            CATALOG_CACHE_REQUESTS.labels(result="hit").inc()
+            return entry
+
+        CATALOG_CACHE_REQUESTS.labels(result="miss").inc()
+        raw = build()
+        variants = {}
+        if len(raw) >= COMPRESSION_MIN_SIZE:
+            for encoding in COMPRESSORS:
+                compressed = compress_body(raw, encoding)
+                if len(compressed) < len(raw):
+                    variants[encoding] = compressed
+        entry = {"raw": raw, "variants": variants}
+
+        with self._lock:
+            # Drop the entry if the catalog changed while it was being built
+            if self.version == version and len(self._entries) < self.max_entries:
+                self._entries[key] = entry
+        return entry
+
+catalog_cache = CatalogCache()
+
+# ==================== CATALOG READ MODEL ====================
+def sellable_products():
+    """Produits visibles et achetables : approuvés, avec leur vendeur et leur catégorie"""
+    return and_(
+        Product.status == ProductStatus.APPROVED,
+        Product.vendor_id.isnot(None),
+        Product.category_id.isnot(None)
+    )
+
+def catalog_rows():
+    """Produits approuvés (avec catégorie et vendeur) aplatis, dans l'ordre des colonnes de catalog_products"""
+    return select(
+        Product.id, Product.name, Product.description, Product.price, Product.stock, Product.image_url,
+        Product.category_id, Category.name,
+        Product.vendor_id, func.coalesce(User.business_name, User.username)
+    ).join(Category, Category.id == Product.category_id).join(
+        User, User.id == Product.vendor_id
+    ).where(Product.status == ProductStatus.APPROVED)
+
+CATALOG_COLUMNS = [
+    "id", "name", "description", "price", "stock", "image_url",
+    "category_id", "category_name", "vendor_id", "vendor_name"
+]
+
+def refresh_category_stats(db: Session, category_ids):
+    """Recalculer nombre de produits et prix min/max des catégories touchées (lecture d'index par catégorie)"""
+    for category_id in sorted(category_ids):
+        # Write the counters row first: concurrent refreshes of a category run one after the other
+        locked = db.query(CategoryStats).filter(CategoryStats.category_id == category_id).update(
+            {CategoryStats.product_count: CategoryStats.product_count}, synchronize_session=False
+        )
+        count, min_price, max_price = db.query(
+            func.count(CatalogProduct.id), func.min(CatalogProduct.price), func.max(CatalogProduct.price)
+        ).filter(CatalogProduct.category_id == category_id).one()
+        if locked:
+            db.query(CategoryStats).filter(CategoryStats.category_id == category_id).update({
+                CategoryStats.product_count: count,
+                CategoryStats.min_price: min_price,
+                CategoryStats.max_price: max_price,
+            }, synchronize_session=False)
+        else:
+            db.add(CategoryStats(category_id=category_id, product_count=count, min_price=min_price, max_price=max_price))
+
+def sync_catalog_product(db: Session, product_id: int):
+    """Mettre à jour la ligne du read model d'un produit (créé, modifié, validé ou supprimé) dans la transaction de l'appelant"""
+    db.flush()
+    previous_category = db.query(CatalogProduct.category_id).filter(CatalogProduct.id == product_id).scalar()
+    db.query(CatalogProduct).filter(CatalogProduct.id == product_id).delete(synchronize_session=False)
+    db.execute(insert(CatalogProduct).from_select(CATALOG_COLUMNS, catalog_rows().where(Product.id == product_id)))
+    category = db.query(Product.category_id).filter(Product.id == product_id).scalar()
+    refresh_category_stats(db, {previous_category, category} - {None})
+
+def remove_from_catalog(db: Session, column, value):
+    """Retirer du read model tous les produits d'une catégorie ou d'un vendeur"""
+    categories = {row[0] for row in db.query(CatalogProduct.category_id).filter(column == value).distinct()}
+    db.query(CatalogProduct).filter(column == value).delete(synchronize_session=False)
+    refresh_category_stats(db, categories - {None})
+
+def rebuild_catalog_read_model(db: Session):
+    db.query(CatalogProduct).delete(synchronize_session=False)
+    db.execute(insert(CatalogProduct).from_select(CATALOG_COLUMNS, catalog_rows()))
+    db.query(CategoryStats).delete(synchronize_session=False)
+    db.execute(insert(CategoryStats).from_select(CATEGORY_STATS_COLUMNS, category_stats_rows()))
+
+CATEGORY_STATS_COLUMNS = ["category_id", "product_count", "min_price", "max_price"]
+
+def category_stats_rows():
+    """Statistiques par catégorie calculées depuis catalog_products"""
+    return select(
+        Category.id, func.count(CatalogProduct.id), func.min(CatalogProduct.price), func.max(CatalogProduct.price)
+    ).outerjoin(CatalogProduct, CatalogProduct.category_id == Category.id).group_by(Category.id)
+
+def catalog_read_model_drifted(db: Session) -> bool:
+    """Vrai si une ligne du read model diffère des tables sources (contenu comparé, pas seulement le nombre)"""
+    stored_products = select(*[CatalogProduct.__table__.c[name] for name in CATALOG_COLUMNS])
+    stored_stats = select(*[CategoryStats.__table__.c[name] for name in CATEGORY_STATS_COLUMNS])
+    for live, stored in ((catalog_rows(), stored_products), (category_stats_rows(), stored_stats)):
+        # Both directions: rows missing from the model and rows the model should no longer have
+        for difference in (live.except_(stored), stored.except_(live)):
+            if db.execute(difference.limit(1)).first() is not None:
+                return True
+    return False
+
+def ensure_catalog_read_model():
+    """Reconstruire le read model au démarrage s'il ne correspond pas aux tables (nouvelle base, mise à jour, écriture hors API)"""
+    db = SessionLocal()
+    try:
+        if catalog_read_model_drifted(db):
+            rebuild_catalog_read_model(db)
+            # Workers already running keep lists built from the previous read model
+            catalog_cache.invalidate(db)
+            db.commit()
+    except IntegrityError:
+        db.rollback()  # rebuilt by another worker
+    finally:
+        db.close()
+
+def catalog_response(request: Request, db: Session, key, build) -> Response:
+    """Servir une liste du catalogue depuis le cache, dans l'encodage négocié"""
+    entry = catalog_cache.get(db, key, build)
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    body = entry["variants"].get(encoding)
+    if body is None:
+        body = entry["raw"]
+    else:
+        headers["Content-Encoding"] = encoding
+        COMPRESSED_BYTES_SAVED.labels(encoding=encoding).inc(len(entry["raw"]) - len(body))
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ==================== REALTIME EVENTS ====================
+REALTIME_QUEUE_SIZE = int(os.environ.get("REALTIME_QUEUE_SIZE", "100"))
+REALTIME_HEARTBEAT_SECONDS = 15
+
+REALTIME_CONNECTIONS = Gauge(
+    "realtime_connections",
+    "Open realtime connections",
+    ["channel"],
+    multiprocess_mode="livesum"
+)
+
+REALTIME_FANOUT_LATENCY_MS = Histogram(
+    "realtime_fanout_latency_ms",
+    "Delay between publishing an event and writing it to a subscriber in milliseconds",
+    buckets=[1, 5, 10, 25, 50, 100, 250, 500, 1000]
+)
+
+REALTIME_EVENTS_DROPPED = Counter(
+    "realtime_events_dropped_total",
+    "Events dropped because a subscriber queue was full"
+)
+
+class EventBroker:
+    """Pub/sub en mémoire, limité au processus courant
+
+    Une implémentation basée sur un broker externe (Redis, NATS...) doit
+    exposer les mêmes méthodes subscribe / unsubscribe / publish.
+    """
+
+    def __init__(self, queue_size: int = REALTIME_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+
+    def subscribe(self, *topics) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for topic in topics:
+            self.add_topic(queue, topic)
+        return queue
+
+    def add_topic(self, queue: asyncio.Queue, topic: str):
+        self._subscribers.setdefault(topic, set()).add(queue)
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        for topic in list(self._subscribers):
+            queues = self._subscribers[topic]
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[topic]
+
+    async def publish(self, topic: str, event: dict):
+        message = {"published_at": time.perf_counter(), "data": event}
+        for queue in self._subscribers.get(topic, ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A slow consumer must not block the publisher
+                REALTIME_EVENTS_DROPPED.inc()
+
+event_broker = EventBroker()
+
+def event_payload(message: dict) -> dict:
+    """Extraire l'événement d'un message du broker en mesurant la latence de diffusion"""
+    REALTIME_FANOUT_LATENCY_MS.observe((time.perf_counter() - message["published_at"]) * 1000)
+    return message["data"]
+
+def order_status_event(order: Order) -> dict:
+    return {
+        "event": "order_status",
+        "order_id": order.id,
+        "status": order.status,
+        "delivery_person_id": order.delivery_person_id,
+    }
+
+# ==================== DRIVER LOCATIONS ====================
+LOCATION_FRESH_SECONDS = int(os.environ.get("LOCATION_FRESH_SECONDS", "120"))
+LOCATION_STALE_SECONDS = int(os.environ.get("LOCATION_STALE_SECONDS", "900"))
+LOCATION_FLUSH_SECONDS = int(os.environ.get("LOCATION_FLUSH_SECONDS", "30"))
+
+LOCATION_POINTS_INGESTED = Counter(
+    "driver_location_points_total",
+    "Driver location points received"
+)
+
+DRIVER_POSITIONS_TRACKED = Gauge(
+    "driver_positions_tracked",
+    "Drivers with a position in the in-memory store",
+    multiprocess_mode="livesum"
+)
+
+LOCATION_FLUSH_DURATION_MS = Histogram(
+    "driver_location_flush_duration_ms",
+    "Time spent writing buffered driver positions to the database in milliseconds",
+    buckets=[1, 5, 10, 25, 50, 100, 250, 500, 1000]
+)
+
+class DriverLocationStore:
+    """Dernières positions connues des livreurs, en mémoire
+
+    Les positions sont écrites en base par lots (voir flush_driver_locations)
+    au lieu d'un commit par point reçu.
+    """
+
+    def __init__(self):
+        self._positions = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def record(self, driver_id: int, latitude: float, longitude: float, recorded_at: Optional[float] = None):
+        now = time.time()
+        recorded_at = min(recorded_at or now, now)
+        with self._lock:
+            current = self._positions.get(driver_id)
+            # Out of order points (late batch, retry) never overwrite a newer position
+            if current is not None and current[2] >= recorded_at:
+                return
+            self._positions[driver_id] = (latitude, longitude, recorded_at)
+            self._dirty.add(driver_id)
+            DRIVER_POSITIONS_TRACKED.set(len(self._positions))
+
+    def get(self, driver_id: int, max_age: int = LOCATION_FRESH_SECONDS):
+        position = self._positions.get(driver_id)
+        if position is None or time.time() - position[2] > max_age:
+            return None
+        return position
+
+    def evict_stale(self, max_age: int = LOCATION_STALE_SECONDS):
+        limit = time.time() - max_age
+        with self._lock:
+            for driver_id in [k for k, v in self._positions.items() if v[2] < limit]:
+                del self._positions[driver_id]
+            DRIVER_POSITIONS_TRACKED.set(len(self._positions))
+
+    def drain_dirty(self) -> dict:
+        with self._lock:
+            changed = {
+                driver_id: self._positions[driver_id]
+                for driver_id in self._dirty
+                if driver_id in self._positions
+            }
+            self._dirty.clear()
+        return changed
+
+    def restore_dirty(self, driver_ids):
+        """Remettre à écrire des positions dont le flush a échoué"""
+        with self._lock:
+            self._dirty.update(driver_id for driver_id in driver_ids if driver_id in self._positions)
+
+driver_locations = DriverLocationStore()
+
+def flush_driver_locations():
+    """Écrire en base, en une transaction, les positions modifiées depuis le dernier flush"""
+    changed = driver_locations.drain_dirty()
+    if not changed:
+        return
+    start_time = time.perf_counter()
+    db = SessionLocal()
+    try:
+        db.execute(update(User), [
+            {"id": driver_id, "latitude": latitude, "longitude": longitude}
+            for driver_id, (latitude, longitude, _) in changed.items()
+        ])
+        db.commit()
+    except Exception:
+        # Positions recorded since the drain are newer and already dirty: the next flush writes the latest
+        driver_locations.restore_dirty(changed)
+        raise
+    finally:
+        db.close()
+    LOCATION_FLUSH_DURATION_MS.observe((time.perf_counter() - start_time) * 1000)
+
+async def location_flush_loop():
+    while True:
+        await asyncio.sleep(LOCATION_FLUSH_SECONDS)
+        try:
+            driver_locations.evict_stale()
+            await run_in_threadpool(flush_driver_locations)
+        except Exception:
+            logger.exception("Driver location flush failed")
+
+# ==================== ROUTE PLANNING ====================
+ROUTE_BATCH_WINDOW_SECONDS = int(os.environ.get("ROUTE_BATCH_WINDOW_SECONDS", "30"))
+ROUTE_MAX_ORDERS = int(os.environ.get("ROUTE_MAX_ORDERS", "5"))
+ROUTE_VENDOR_RADIUS_KM = float(os.environ.get("ROUTE_VENDOR_RADIUS_KM", "2"))
+ROUTE_CLIENT_RADIUS_KM = float(os.environ.get("ROUTE_CLIENT_RADIUS_KM", "3"))
+ROUTE_CANDIDATE_LIMIT = 200
+
+ROUTE_PLANNING_DURATION_MS = Histogram(
+    "route_planning_duration_ms",
+    "Time spent batching orders and ordering route stops in milliseconds",
+    buckets=[0.5, 1, 2, 5, 10, 25, 50, 100, 250]
+)
+
+ROUTE_ORDERS = Histogram(
+    "route_orders",
+    "Number of orders carried by a planned delivery route",
+    buckets=[1, 2, 3, 4, 5, 8, 10]
+)
+
+def distance_matrix(points):
+    """Distances Haversine (km) entre tous les points (latitude, longitude)"""
+    return [[calculate_distance(a[0], a[1], b[0], b[1]) for b in points] for a in points]
+
+def path_length(matrix, path) -> float:
+    return sum(matrix[a][b] for a, b in zip(path, path[1:]))
+
+def nearest_neighbour_path(matrix, start: int, nodes) -> list:
+    path, remaining = [start], set(nodes)
+    while remaining:
+        last = path[-1]
+        closest = min(remaining, key=lambda node: (matrix[last][node], node))
+        path.append(closest)
+        remaining.remove(closest)
+    return path
+
+def two_opt(matrix, path) -> list:
+    """Améliorer un chemin ouvert (premier point fixe) en inversant des segments"""
+    path = list(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                before = matrix[path[i - 1]][path[i]]
+                after = matrix[path[i - 1]][path[j]]
+                if j + 1 < len(path):
+                    before += matrix[path[j]][path[j + 1]]
+                    after += matrix[path[i]][path[j + 1]]
+                if after < before - 1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    improved = True
+    return path
+
+def plan_route(start, pickups, dropoffs, optimize: bool = True):
+    """Ordonner les arrêts d'une tournée : tous les retraits, puis toutes les livraisons
+
+    start, pickups[i], dropoffs[i] sont des (latitude, longitude). Retourne
+    la liste des arrêts sous forme (StopKind, index) et la longueur en km.
+    """
+    points = [start] + list(pickups) + list(dropoffs)
+    matrix = distance_matrix(points)
+    pickup_nodes = range(1, 1 + len(pickups))
+    dropoff_nodes = range(1 + len(pickups), len(points))
+
+    first_leg = nearest_neighbour_path(matrix, 0, pickup_nodes)
+    if optimize:
+        first_leg = two_opt(matrix, first_leg)
+    second_leg = nearest_neighbour_path(matrix, first_leg[-1], dropoff_nodes)
+    if optimize:
+        second_leg = two_opt(matrix, second_leg)
+    path = first_leg + second_leg[1:]
+
+    stops = [
+        (StopKind.PICKUP, node - 1) if node <= len(pickups) else (StopKind.DROPOFF, node - 1 - len(pickups))
+        for node in path[1:]
+    ]
+    return stops, path_length(matrix, path)
+
+def group_orders(orders, max_orders: int = ROUTE_MAX_ORDERS,
+                 vendor_radius_km: float = ROUTE_VENDOR_RADIUS_KM,
+                 client_radius_km: float = ROUTE_CLIENT_RADIUS_KM):
+    """Regrouper des commandes (les plus anciennes d'abord) en lots pour un même livreur
+
+    Chaque commande est un tuple (id, vendeur (lat, lon), client (lat, lon)) ;
+    une commande rejoint le lot d'une commande plus ancienne si son vendeur et
+    son client sont proches de ceux de cette commande.
+    """
+    remaining = list(orders)
+    batches = []
+    while remaining:
+        seed = remaining.pop(0)
+        batch = [seed]
+        for order in list(remaining):
+            if len(batch) >= max_orders:
+                break
+            if (calculate_distance(*seed[1], *order[1]) <= vendor_radius_km
+                    and calculate_distance(*seed[2], *order[2]) <= client_radius_km):
+                batch.append(order)
+                remaining.remove(order)
+        batches.append(batch)
+    return batches
+
+# ==================== JOB QUEUE ====================
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "1"))
+JOB_LOCK_TIMEOUT_SECONDS = int(os.environ.get("JOB_LOCK_TIMEOUT_SECONDS", "300"))
+JOB_BACKOFF_BASE_SECONDS = float(os.environ.get("JOB_BACKOFF_BASE_SECONDS", "2"))
+JOB_BACKOFF_MAX_SECONDS = float(os.environ.get("JOB_BACKOFF_MAX_SECONDS", "300"))
+
+JOBS_PROCESSED = Counter(
+    "jobs_processed_total",
+    "Background jobs executed, by outcome",
+    ["kind", "result"]
+)
+
+JOB_LAG_SECONDS = Histogram(
+    "job_lag_seconds",
+    "Delay between the time a job was due and the time a worker picked it up",
+    ["kind"],
+    buckets=[0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300]
+)
+
+JOB_DURATION_MS = Histogram(
+    "job_duration_ms",
+    "Background job execution time in milliseconds",
+    ["kind"],
+    buckets=[5, 10, 50, 100, 300, 1000, 5000, 30000]
+)
+
+JOB_HANDLERS = {}
+job_wakeup = asyncio.Event()
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def job_handler(kind: str):
+    """Enregistrer une fonction (db, payload) pour un type de job
+
+    Elle s'exécute dans le threadpool et peut retourner une liste de
+    (topic, événement) à publier une fois le job terminé.
+    """
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue_job(db: Session, kind: str, payload: dict, max_attempts: int = 5, delay_seconds: float = 0) -> Job:
+    """Ajouter un job à la session courante : il est persisté avec le commit de l'appelant"""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload),
+        max_attempts=max_attempts,
+        run_at=utcnow() + timedelta(seconds=delay_seconds)
+    )
+    db.add(job)
+    return job
+
+def job_backoff_seconds(attempts: int) -> float:
+    delay = min(JOB_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), JOB_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.9, 1.1)  # nosec B311 - jitter, not security related
+
+def claim_next_job(db: Session) -> Optional[Job]:
+    """Réserver le prochain job exécutable (ou dont le worker ne répond plus)"""
+    now = utcnow()
+    candidate = db.query(Job.id, Job.status, Job.attempts).filter(
+        or_(
+            and_(Job.status == JobStatus.PENDING, Job.run_at <= now),
+            and_(
+                Job.status == JobStatus.RUNNING,
+                Job.locked_at < now - timedelta(seconds=JOB_LOCK_TIMEOUT_SECONDS)
+            ),
+        )
+    ).order_by(Job.run_at).first()
+    if candidate is None:
+        return None
+
+    # Compare-and-set on (status, attempts) so that a single worker wins the job
+    claimed = db.query(Job).filter(
+        Job.id == candidate.id,
+        Job.status == candidate.status,
+        Job.attempts == candidate.attempts
+    ).update({
+        Job.status: JobStatus.RUNNING,
+        Job.locked_at: now,
+        Job.attempts: candidate.attempts + 1,
+    }, synchronize_session=False)
+    db.commit()
+    if claimed != 1:
+        return None
+    job = db.get(Job, candidate.id)
+    JOB_LAG_SECONDS.labels(kind=job.kind).observe(max((now - job.run_at).total_seconds(), 0))
+    return job
+
+def run_next_job() -> Optional[list]:
+    """Exécuter un job ; retourne None si la file est vide, sinon les événements à publier"""
+    db = SessionLocal()
+    events = []
+    try:
+        job = claim_next_job(db)
+        if job is None:
+            return None
+
+        job_id, kind = job.id, job.kind
+        start_time = time.perf_counter()
+        try:
+            handler = JOB_HANDLERS.get(kind)
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{kind}'")
+            events = handler(db, json.loads(job.payload)) or []
+        except Exception as exc:
+            db.rollback()
+            job = db.get(Job, job_id)
+            job.last_error = repr(exc)[:1000]
+            if job.attempts >= job.max_attempts:
+                job.status = JobStatus.FAILED
+                job.finished_at = utcnow()
+                result = "failed"
+            else:
+                job.status = JobStatus.PENDING
+                job.run_at = utcnow() + timedelta(seconds=job_backoff_seconds(job.attempts))
+                result = "retry"
+            logger.warning(json.dumps({
+                "event": "job_error",
+                "job_id": job_id,
+                "kind": kind,
+                "attempts": job.attempts,
+                "result": result,
+                "error": job.last_error
+            }))
+        else:
+            job = db.get(Job, job_id)
+            job.status = JobStatus.DONE
+            job.finished_at = utcnow()
+            result = "done"
+        db.commit()
+
+        JOBS_PROCESSED.labels(kind=kind, result=result).inc()
+        JOB_DURATION_MS.labels(kind=kind).observe((time.perf_counter() - start_time) * 1000)
+        return events if result == "done" else []
+    finally:
+        db.close()
+
+async def job_worker_loop():
+    while True:
+        # Database work runs in the threadpool: a busy connection pool must not block the event loop
+        try:
+            events = await run_in_threadpool(run_next_job)
+            for topic, event in events or ():
+                await event_broker.publish(topic, event)
+        except Exception:
+            logger.exception("Job worker iteration failed")
+            events = None
+        if events is None:
+            job_wakeup.clear()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+# ==================== IDEMPOTENCY ====================
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+
+IDEMPOTENT_REPLAYS = Counter(
+    "idempotent_replays_total",
+    "Requests answered from a stored Idempotency-Key response"
+)
+
+def request_fingerprint(request: Request) -> str:
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    return hashlib.sha256(f"{request.method} {request.url.path}?{query}".encode()).hexdigest()
+
+def find_idempotent_response(db: Session, key: str, fingerprint: str) -> Optional[JSONResponse]:
+    """Rejouer la réponse déjà enregistrée pour cette clé, si elle existe et n'a pas expiré"""
+    record = db.query(IdempotencyKey).filter(
+        IdempotencyKey.key == key,
+        IdempotencyKey.created_at >= utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    ).first()
+    if record is None:
+        return None
+    if record.fingerprint != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key already used for a different request")
+    IDEMPOTENT_REPLAYS.inc()
+    return JSONResponse(
+        status_code=record.response_status,
+        content=json.loads(record.response_body),
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def store_idempotent_response(db: Session, key: str, fingerprint: str, body: dict, status_code: int = 200):
+    """Enregistrer la réponse dans la transaction courante (purge au passage les clés expirées)"""
+    now = utcnow()
+    db.query(IdempotencyKey).filter(
+        IdempotencyKey.created_at < now - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    ).delete(synchronize_session=False)
+    db.add(IdempotencyKey(
+        key=key,
+        fingerprint=fingerprint,
+        response_status=status_code,
+        response_body=json.dumps(body),
+        created_at=now
+    ))
+
+# ==================== INVENTORY ====================
+CART_RESERVATION_SECONDS = int(os.environ.get("CART_RESERVATION_SECONDS", "900"))
+CHECKOUT_RESERVATION_SECONDS = int(os.environ.get("CHECKOUT_RESERVATION_SECONDS", "1800"))
+INVENTORY_SWEEP_SECONDS = float(os.environ.get("INVENTORY_SWEEP_SECONDS", "30"))
+INVENTORY_SWEEP_BATCH_SIZE = 500
+STOCK_SHARDS_MAX = 64
+
+STOCK_RESERVATIONS = Counter(
+    "stock_reservations_total",
+    "Stock reservation attempts, by outcome",
+    ["result"]
+)
+
+STOCK_RELEASED = Counter(
+    "stock_released_units_total",
+    "Reserved units given back to the available stock",
+    ["reason"]
+)
+
+def take_stock(db: Session, product_id: int, quantity: int) -> bool:
+    """Décrémenter le stock disponible s'il est suffisant (UPDATE conditionnel)
+
+    Sur échec, des shards ont pu être partiellement décrémentés : l'appelant
+    doit annuler la transaction.
+    """
+    shards = db.query(StockShard.shard, StockShard.stock).filter(StockShard.product_id == product_id).all()
+    if not shards:
+        return db.query(Product).filter(
+            Product.id == product_id,
+            Product.stock >= quantity
+        ).update({Product.stock: Product.stock - quantity}, synchronize_session=False) == 1
+
+    # Random order so that concurrent buyers of a hot product update different rows
+    random.shuffle(shards)  # nosec B311 - load spreading, not security related
+    remaining = quantity
+    for shard, available in shards:
+        taken = min(remaining, available)
+        if taken <= 0:
+            continue
+        remaining -= db.query(StockShard).filter(
+            StockShard.product_id == product_id,
+            StockShard.shard == shard,
+            StockShard.stock >= taken
+        ).update({StockShard.stock: StockShard.stock - taken}, synchronize_session=False) * taken
+        if remaining == 0:
+            return True
+    return False
+
+def give_back_stock(db: Session, product_id: int, quantity: int):
+    shard = db.query(StockShard.shard).filter(StockShard.product_id == product_id).order_by(func.random()).first()
+    if shard is None:
+        db.query(Product).filter(Product.id == product_id).update(
+            {Product.stock: Product.stock + quantity}, synchronize_session=False
+        )
+    else:
+        db.query(StockShard).filter(
+            StockShard.product_id == product_id,
+            StockShard.shard == shard.shard
+        ).update({StockShard.stock: StockShard.stock + quantity}, synchronize_session=False)
+
+def set_stock_shards(db: Session, product_id: int, shards: int, total: Optional[int] = None) -> int:
+    """Répartir le stock disponible d'un produit sur N shards (1 = une seule ligne) ; retourne le stock total"""
+    # Write the product row first so that concurrent reservations wait for the redistribution
+    db.query(Product).filter(Product.id == product_id).update(
+        {Product.stock: Product.stock}, synchronize_session=False
+    )
+    # DELETE ... RETURNING reads and removes the shards atomically
+    removed = db.execute(
+        delete(StockShard).where(StockShard.product_id == product_id).returning(StockShard.stock)
+    ).scalars().all()
+    if total is None:
+        total = sum(removed) if removed else db.query(Product.stock).filter(Product.id == product_id).scalar()
+    if shards > 1:
+        base, extra = divmod(total, shards)
+        db.add_all([
+            StockShard(product_id=product_id, shard=shard, stock=base + (1 if shard < extra else 0))
+            for shard in range(shards)
+        ])
+    db.query(Product).filter(Product.id == product_id).update({Product.stock: total}, synchronize_session=False)
+    return total
+
+def set_stock_on_hand(db: Session, product_id: int, on_hand: int) -> Optional[int]:
+    """Fixer le stock physique d'un produit, unités réservées comprises
+
+    Retourne le stock disponible (physique moins réservé), ou None si les
+    réservations en cours dépassent le stock indiqué.
+    """
+    # Lock the product row and its shards before counting: reservations in flight commit first
+    db.query(Product).filter(Product.id == product_id).update(
+        {Product.stock: Product.stock}, synchronize_session=False
+    )
+    shards = db.query(StockShard).filter(StockShard.product_id == product_id).update(
+        {StockShard.stock: StockShard.stock}, synchronize_session=False
+    )
+    reserved = db.query(func.coalesce(func.sum(StockReservation.quantity), 0)).filter(
+        StockReservation.product_id == product_id
+    ).scalar()
+    if reserved > on_hand:
+        return None
+    if shards:
+        return set_stock_shards(db, product_id, shards, total=on_hand - reserved)
+    db.query(Product).filter(Product.id == product_id).update(
+        {Product.stock: on_hand - reserved}, synchronize_session=False
+    )
+    return on_hand - reserved
+
+def release_expired_reservations(batch_size: int = INVENTORY_SWEEP_BATCH_SIZE) -> list:
+    """Rendre au stock les paniers abandonnés et annuler les commandes non payées à temps
+
+    Retourne les événements order_status des commandes annulées.
+    """
+    db = SessionLocal()
+    events = []
+    try:
+        now = utcnow()
+        expired = db.query(
+            StockReservation.id, StockReservation.session_id, StockReservation.product_id, StockReservation.quantity
+        ).filter(
+            StockReservation.order_id.is_(None),
+            StockReservation.expires_at < now
+        ).limit(batch_size).all()
+        for reservation in expired:
+            # Guarded delete: the reservation may have been extended or checked out meanwhile
+            released = db.query(StockReservation).filter(
+                StockReservation.id == reservation.id,
+                StockReservation.order_id.is_(None),
+                StockReservation.expires_at < now
+            ).delete(synchronize_session=False)
+            if released:
+                give_back_stock(db, reservation.product_id, reservation.quantity)
+                db.query(CartItem).filter(
+                    CartItem.session_id == reservation.session_id,
+                    CartItem.product_id == reservation.product_id
+                ).delete(synchronize_session=False)
+                STOCK_RELEASED.labels(reason="cart_expired").inc(reservation.quantity)
+        db.commit()
+
+        order_ids = [row[0] for row in db.query(StockReservation.order_id).filter(
+            StockReservation.order_id.isnot(None),
+            StockReservation.expires_at < now
+        ).distinct().limit(batch_size).all()]
+        for order_id in order_ids:
+            # Same guarded transition as the payment: either the payment or the expiry wins
+            cancelled = db.query(Order).filter(
+                Order.id == order_id,
+                Order.status == OrderStatus.PENDING
+            ).update({Order.status: OrderStatus.CANCELLED}, synchronize_session=False)
+            reservations = db.query(StockReservation).filter(StockReservation.order_id == order_id).all()
+            for reservation in reservations:
+                if cancelled:
+                    give_back_stock(db, reservation.product_id, reservation.quantity)
+                    STOCK_RELEASED.labels(reason="checkout_expired").inc(reservation.quantity)
+                db.delete(reservation)
+            db.commit()
+            if cancelled:
+                events.append(order_status_event(db.get(Order, order_id)))
+
+        # Displayed stock of sharded products is the sum of their shards
+        db.query(Product).filter(
+            Product.id.in_(select(StockShard.product_id))
+        ).update({
+            Product.stock: select(func.sum(StockShard.stock)).where(
+                StockShard.product_id == Product.id
+            ).scalar_subquery()
+        }, synchronize_session=False)
+        # Stock shown by the catalog read model
+        live_stock = select(Product.stock).where(Product.id == CatalogProduct.id).scalar_subquery()
+        refreshed = db.query(CatalogProduct).filter(CatalogProduct.stock.is_distinct_from(live_stock)).update(
+            {CatalogProduct.stock: live_stock}, synchronize_session=False
+        )
+        if refreshed:
+            # Cached product lists are built from the read model
+            catalog_cache.invalidate(db)
+        db.commit()
+        return events
+    finally:
+        db.close()
+
+async def inventory_sweep_loop():
+    while True:
+        await asyncio.sleep(INVENTORY_SWEEP_SECONDS)
+        try:
+            events = await run_in_threadpool(release_expired_reservations)
+            for event in events:
+                await event_broker.publish(f"order:{event['order_id']}", event)
+        except Exception:
+            logger.exception("Inventory sweep failed")
+
+# ==================== ORDER ARCHIVE ====================
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get("ORDER_ARCHIVE_AFTER_DAYS", "90"))  # 0 disables archival
+ORDER_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("ORDER_ARCHIVE_INTERVAL_SECONDS", "3600"))
+ORDER_ARCHIVE_BATCH_SIZE = int(os.environ.get("ORDER_ARCHIVE_BATCH_SIZE", "500"))
+ORDER_EXPORT_CHUNK_ROWS = int(os.environ.get("ORDER_EXPORT_CHUNK_ROWS", "5000"))
+ARCHIVED_ORDER_STATUSES = (OrderStatus.DELIVERED, OrderStatus.CANCELLED)
+ARCHIVE_INDEXED_COLUMNS = {"order_number", "order_id", "created_at"}
+ARCHIVE_TABLE_NAME = re.compile(r"^orders_archive_(\d{6})$")
+
+ORDERS_ARCHIVED = Counter(
+    "orders_archived_total",
+    "Orders moved from the hot tables to the monthly archive tables"
+)
+
+# Archive partitions and history views are created on demand, outside Base.metadata
+archive_metadata = MetaData()
+
+def archive_table(source: Table, month: str) -> Table:
+    """Table d'archive mensuelle (YYYYMM) d'une table chaude : mêmes colonnes, sans clés étrangères"""
+    name = f"{source.name}_archive_{month}"
+    if name not in archive_metadata.tables:
+        Table(name, archive_metadata, *[
+            Column(column.name, column.type, primary_key=column.primary_key, index=column.name in ARCHIVE_INDEXED_COLUMNS)
+            for column in source.columns
+        ])
+    return archive_metadata.tables[name]
+
+def history_table(source: Table) -> Table:
+    """Vue <table>_history : table chaude et toutes ses archives mensuelles"""
+    name = f"{source.name}_history"
+    if name not in archive_metadata.tables:
+        Table(name, archive_metadata, *[Column(column.name, column.type) for column in source.columns])
+    return archive_metadata.tables[name]
+
+def archive_months(bind) -> List[str]:
+    return sorted(
+        match.group(1)
+        for match in map(ARCHIVE_TABLE_NAME.match, inspect(bind).get_table_names())
+        if match
+    )
+
+def drop_history_views(connection):
+    for source in (Order.__table__, OrderItem.__table__):
+        connection.exec_driver_sql(f"DROP VIEW IF EXISTS {source.name}_history")
+
+def create_history_views(connection):
+    """Créer les vues orders_history et order_items_history sur les partitions existantes"""
+    months = archive_months(connection)
+    inspector = inspect(connection)
+    drop_history_views(connection)
+    for source in (Order.__table__, OrderItem.__table__):
+        selects = [f"SELECT {', '.join(c.name for c in source.columns)} FROM {source.name}"]
+        for month in months:
+            partition = f"{source.name}_archive_{month}"
+            # Partitions created before a column was added expose it as NULL
+            existing = {column["name"] for column in inspector.get_columns(partition)}
+            columns = ", ".join(c.name if c.name in existing else f"NULL AS {c.name}" for c in source.columns)
+            selects.append(f"SELECT {columns} FROM {partition}")
+        connection.exec_driver_sql(
+            f"CREATE VIEW {source.name}_history AS " + " UNION ALL ".join(selects)  # nosec B608 - table names from metadata
+        )
+
+def refresh_history_views(bind=None):
+    """(Re)créer les vues d'historique dans leur propre transaction"""
+    with (bind or engine).begin() as connection:
+        create_history_views(connection)
+
+# The views follow the hot tables through drop_all / create_all (test fixtures, resets):
+# a dangling view would break reads, and some databases refuse to drop a table a view depends on
+@listens_for(Order.__table__, "before_drop")
+@listens_for(OrderItem.__table__, "before_drop")
+def drop_history_views_before_drop(target, connection, **kw):
+    drop_history_views(connection)
+
+@listens_for(OrderItem.__table__, "after_create")
+def create_history_views_after_create(target, connection, **kw):
+    # order_items is created after orders (foreign key), so both tables exist here
+    create_history_views(connection)
+
+def archive_orders(older_than_days: int = ORDER_ARCHIVE_AFTER_DAYS, batch_size: int = ORDER_ARCHIVE_BATCH_SIZE) -> int:
+    """Déplacer par lots les commandes livrées ou annulées depuis plus de N jours vers leur partition mensuelle"""
+    cutoff = utcnow() - timedelta(days=older_than_days)
+    orders_table, items_table = Order.__table__, OrderItem.__table__
+    archived = 0
+    new_partitions = False
+    start_time = time.perf_counter()
+    while True:
+        # One transaction per batch: a batch is either in the hot tables or in the archive
+        with engine.begin() as connection:
+            orders = [dict(row) for row in connection.execute(
+                select(orders_table).where(
+                    orders_table.c.status.in_(ARCHIVED_ORDER_STATUSES),
+                    # Age counted from delivery; cancelled orders (expired reservations) have no
+                    # cancellation date and are cancelled shortly after creation
+                    func.coalesce(orders_table.c.delivered_at, orders_table.c.created_at) < cutoff
+                ).order_by(orders_table.c.id).limit(batch_size)
+            ).mappings()]
+            if not orders:
+                break
+            order_ids = [order["id"] for order in orders]
+            months = {order["id"]: order["created_at"].strftime("%Y%m") for order in orders}
+            items = [dict(row) for row in connection.execute(
+                select(items_table).where(items_table.c.order_id.in_(order_ids))
+            ).mappings()]
+
+            for month in sorted(set(months.values())):
+                orders_archive = archive_table(orders_table, month)
+                items_archive = archive_table(items_table, month)
+                if not inspect(connection).has_table(orders_archive.name):
+                    archive_metadata.create_all(connection, tables=[orders_archive, items_archive])
+                    new_partitions = True
+                connection.execute(orders_archive.insert(), [o for o in orders if months[o["id"]] == month])
+                month_items = [i for i in items if months[i["order_id"]] == month]
+                if month_items:
+                    connection.execute(items_archive.insert(), month_items)
+
+            # Route stops only matter while the order is being delivered
+            route_ids = connection.execute(
+                select(RouteStop.route_id).where(RouteStop.order_id.in_(order_ids)).distinct()
+            ).scalars().all()
+            connection.execute(delete(RouteStop).where(RouteStop.order_id.in_(order_ids)))
+            if route_ids:
+                connection.execute(delete(DeliveryRoute).where(
+                    DeliveryRoute.id.in_(route_ids),
+                    ~select(RouteStop.id).where(RouteStop.route_id == DeliveryRoute.id).exists()
+                ))
+            connection.execute(delete(items_table).where(items_table.c.order_id.in_(order_ids)))
+            connection.execute(delete(orders_table).where(orders_table.c.id.in_(order_ids)))
+        archived += len(orders)
+        ORDERS_ARCHIVED.inc(len(orders))
+
+    if new_partitions:
+        refresh_history_views()
+    if archived:
+        logger.info(json.dumps({
+            "event": "orders_archived",
+            "orders": archived,
+            "cutoff": cutoff.isoformat(),
+            "duration_ms": int((time.perf_counter() - start_time) * 1000)
+        }))
+    return archived
+
+async def order_archive_loop():
+    while True:
+        await asyncio.sleep(ORDER_ARCHIVE_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(archive_orders)
+        except Exception:
+            logger.exception("Order archival failed")
+
+def export_value(value):
+    return value.value if isinstance(value, enum.Enum) else value
+
+def export_chunks(query):
+    """Lire le résultat par paquets de ORDER_EXPORT_CHUNK_ROWS lignes sur une connexion dédiée"""
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=ORDER_EXPORT_CHUNK_ROWS).execute(query)
+        for rows in result.partitions():
+            yield [[export_value(value) for value in row] for row in rows]
+
+def export_csv(query, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in columns])
+    for rows in export_chunks(query):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+class ExportSink:
+    """Fichier en écriture seule dont le contenu est vidé au fil de l'export"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_parquet(query, columns):
+    import pyarrow
+    import pyarrow.parquet
+
+    def arrow_type(column_type):
+        if isinstance(column_type, Integer):
+            return pyarrow.int64()
+        if isinstance(column_type, Float):
+            return pyarrow.float64()
+        if isinstance(column_type, Boolean):
+            return pyarrow.bool_()
+        if isinstance(column_type, DateTime):
+            return pyarrow.timestamp("us")
+        return pyarrow.string()
+
+    schema = pyarrow.schema([(column.name, arrow_type(column.type)) for column in columns])
+    sink = ExportSink()
+    # One row group per chunk, sent as soon as it is written
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in export_chunks(query):
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema
+            ))
+            yield sink.drain()
+    yield sink.drain()
+
+# ==================== CASCADING DELETES ====================
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", "1000"))
+
+def withdraw_products(executor, product_ids):
+    """Rendre invendables des produits détachés de leur vendeur ou catégorie, dans la transaction de l'appelant"""
+    executor.execute(update(Product).where(Product.id.in_(product_ids)).values(status=ProductStatus.REJECTED))
+    executor.execute(delete(CartItem).where(CartItem.product_id.in_(product_ids)))
+    # Pending orders keep their reservations: they are paid or expire as usual
+    executor.execute(delete(StockReservation).where(
+        StockReservation.product_id.in_(product_ids),
+        StockReservation.order_id.is_(None)
+    ))
+
+# Foreign keys set to NULL before deleting the vendor or category they point to,
+# with what must happen to the detached rows in the same transaction
+VENDOR_REFERENCES = [
+    (Product, "vendor_id", withdraw_products),
+    (RouteStop, "vendor_id", None),
+    (Order, "delivery_person_id", None),
+    (DeliveryRoute, "delivery_person_id", None),
+]
+CATEGORY_REFERENCES = [(Product, "category_id", withdraw_products)]
+
+def detach_batch(executor, model, column_name: str, value: int, on_detach=None, limit: Optional[int] = None) -> int:
+    """Mettre à NULL la clé étrangère d'un lot de lignes (toutes si limit est None) ; retourne leur nombre"""
+    query = select(model.id).where(getattr(model, column_name) == value)
+    if limit is not None:
+        query = query.limit(limit)
+    ids = executor.execute(query).scalars().all()
+    if ids:
+        executor.execute(update(model).where(model.id.in_(ids)).values({column_name: None}))
+        if on_detach is not None:
+            on_detach(executor, ids)
+    return len(ids)
+
+def detach_references(references, value: int, batch_size: int = PURGE_BATCH_SIZE) -> int:
+    """Détacher par lots les lignes qui référencent une ligne à supprimer, une transaction par lot"""
+    detached = 0
+    start_time = time.perf_counter()
+    for model, column_name, on_detach in references:
+        while True:
+            # Short transactions: writers on these tables only wait for one batch
+            with engine.begin() as connection:
+                count = detach_batch(connection, model, column_name, value, on_detach, limit=batch_size)
+            detached += count
+            if count < batch_size:
+                break
+    if detached:
+        logger.info(json.dumps({
+            "event": "references_detached",
+            "columns": [f"{model.__tablename__}.{column_name}" for model, column_name, _ in references],
+            "value": value,
+            "rows": detached,
+            "duration_ms": int((time.perf_counter() - start_time) * 1000)
+        }))
+    return detached
+
 # ==================== AUTH ENDPOINTS ====================
-@app.post("/token", response_model=Token, tags=["Authentication"])
+@router.post("/token", response_model=Token, tags=["Authentication"])
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """Connexion pour Admin, Vendeur ou Livreur"""
     user = db.query(User).filter(User.username == form_data.username).first()
@@ -475,7 +2239,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/register/vendor", response_model=UserResponse, tags=["Authentication"])
+@router.post("/register/vendor", response_model=UserResponse, tags=["Authentication"])
 async def register_vendor(user: UserCreate, db: Session = Depends(get_db)):
     """Inscription d'un vendeur (avec vérification à faire par admin)"""
     if user.role != UserRole.VENDOR:
@@ -506,7 +2270,7 @@ async def register_vendor(user: UserCreate, db: Session = Depends(get_db)):
     return db_user
 
 # ==================== ADMIN ENDPOINTS ====================
-@app.post("/admin/categories", response_model=CategoryResponse, tags=["Admin - Categories"])
+@router.post("/admin/categories", response_model=CategoryResponse, tags=["Admin - Categories"])
 async def create_category(
     category: CategoryCreate,
     db: Session = Depends(get_db),
@@ -515,11 +2279,14 @@ async def create_category(
     """Créer une catégorie (Admin uniquement)"""
     db_category = Category(**category.dict())
     db.add(db_category)
+    db.flush()
+    db.add(CategoryStats(category_id=db_category.id, product_count=0))
+    catalog_cache.invalidate(db)
     db.commit()
     db.refresh(db_category)
     return db_category
 
-@app.delete("/admin/categories/{category_id}", tags=["Admin - Categories"])
+@router.delete("/admin/categories/{category_id}", tags=["Admin - Categories"])
 async def delete_category(
     category_id: int,
     db: Session = Depends(get_db),
@@ -529,11 +2296,21 @@ async def delete_category(
     category = db.query(Category).filter(Category.id == category_id).first()
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
+    # Its products leave the public catalog at once, then are detached in batches
+    remove_from_catalog(db, CatalogProduct.category_id, category_id)
+    catalog_cache.invalidate(db)
+    db.commit()
+    await run_in_threadpool(detach_references, CATEGORY_REFERENCES, category_id)
+    # Products moved into the category meanwhile are detached with the deletion itself
+    remove_from_catalog(db, CatalogProduct.category_id, category_id)
+    detach_batch(db, Product, "category_id", category_id, withdraw_products)
+    db.query(CategoryStats).filter(CategoryStats.category_id == category_id).delete(synchronize_session=False)
     db.delete(category)
+    catalog_cache.invalidate(db)
     db.commit()
     return {"message": "Category deleted successfully"}
 
-@app.put("/admin/products/{product_id}/validate", response_model=ProductResponse, tags=["Admin - Products"])
+@router.put("/admin/products/{product_id}/validate", response_model=ProductResponse, tags=["Admin - Products"])
 async def validate_product(
     product_id: int,
     approve: bool,
@@ -546,11 +2323,27 @@ async def validate_product(
         raise HTTPException(status_code=404, detail="Product not found")
     
     product.status = ProductStatus.APPROVED if approve else ProductStatus.REJECTED
+    sync_catalog_product(db, product_id)
+    catalog_cache.invalidate(db)
     db.commit()
     db.refresh(product)
     return product
 
-@app.delete("/admin/vendors/{vendor_id}", tags=["Admin - Vendors"])
+@router.put("/admin/products/{product_id}/stock-shards", tags=["Admin - Products"])
+async def update_stock_shards(
+    product_id: int,
+    shards: int = Query(ge=1, le=STOCK_SHARDS_MAX),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_admin_user)
+):
+    """Découper le stock d'un produit très demandé en plusieurs compteurs (Admin uniquement)"""
+    if not db.query(Product.id).filter(Product.id == product_id).first():
+        raise HTTPException(status_code=404, detail="Product not found")
+    total = set_stock_shards(db, product_id, shards)
+    db.commit()
+    return {"product_id": product_id, "shards": shards, "stock": total}
+
+@router.delete("/admin/vendors/{vendor_id}", tags=["Admin - Vendors"])
 async def delete_vendor(
     vendor_id: int,
     db: Session = Depends(get_db),
@@ -563,11 +2356,92 @@ async def delete_vendor(
     ).first()
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
+    # Deactivated and out of the public catalog at once, then its products are detached in batches
+    vendor.is_active = False
+    remove_from_catalog(db, CatalogProduct.vendor_id, vendor_id)
+    catalog_cache.invalidate(db)
+    db.commit()
+    await run_in_threadpool(detach_references, VENDOR_REFERENCES, vendor_id)
+    # Products created or validated meanwhile are detached with the deletion itself
+    remove_from_catalog(db, CatalogProduct.vendor_id, vendor_id)
+    detach_batch(db, Product, "vendor_id", vendor_id, withdraw_products)
     db.delete(vendor)
+    catalog_cache.invalidate(db)
     db.commit()
     return {"message": "Vendor deleted successfully"}
 
-@app.get("/admin/vendors/pending", response_model=List[UserResponse], tags=["Admin - Vendors"])
+@router.get("/admin/jobs", tags=["Admin - Jobs"])
+async def get_jobs(
+    job_status: Optional[JobStatus] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_admin_user)
+):
+    """État de la file de jobs : compteurs par statut et derniers jobs (Admin uniquement)"""
+    counts = dict(db.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    oldest_pending = db.query(func.min(Job.run_at)).filter(Job.status == JobStatus.PENDING).scalar()
+    query = db.query(Job)
+    if job_status:
+        query = query.filter(Job.status == job_status)
+    jobs = query.order_by(Job.id.desc()).limit(min(max(limit, 1), 500)).all()
+    return {
+        "counts": {s.value: counts.get(s, 0) for s in JobStatus},
+        "oldest_pending_run_at": oldest_pending,
+        "jobs": [JobResponse.model_validate(job) for job in jobs],
+    }
+
+@router.post("/admin/orders/archive", tags=["Admin - Orders"])
+async def run_order_archive(
+    older_than_days: int = Query(ORDER_ARCHIVE_AFTER_DAYS, ge=1),
+    current_user: User = Depends(get_admin_user)
+):
+    """Archiver immédiatement les commandes livrées ou annulées de plus de N jours (Admin uniquement)"""
+    archived = await run_in_threadpool(archive_orders, older_than_days)
+    return {"archived": archived}
+
+@router.get("/admin/orders/export", tags=["Admin - Orders"])
+async def export_orders(
+    dataset: str = Query("orders", pattern="^(orders|order_items)$"),
+    export_format: str = Query("csv", alias="format", pattern="^(csv|parquet)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    """Exporter en flux l'historique complet (commandes chaudes et archivées) en CSV ou Parquet (Admin uniquement)"""
+    if export_format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+
+    orders = history_table(Order.__table__)
+    conditions = []
+    if since:
+        conditions.append(orders.c.created_at >= since)
+    if until:
+        conditions.append(orders.c.created_at < until)
+    if dataset == "orders":
+        source = orders
+        query = select(orders).where(*conditions).order_by(orders.c.id)
+    else:
+        source = history_table(OrderItem.__table__)
+        query = select(source).order_by(source.c.id)
+        if conditions:
+            query = query.where(source.c.order_id.in_(select(orders.c.id).where(*conditions)))
+
+    columns = list(source.columns)
+    filename = f"{dataset}.{export_format}"
+    if export_format == "parquet":
+        body, media_type = export_parquet(query, columns), "application/vnd.apache.parquet"
+    else:
+        body, media_type = export_csv(query, columns), "text/csv; charset=utf-8"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.get("/admin/vendors/pending", response_model=List[UserResponse], tags=["Admin - Vendors"])
 async def get_pending_vendors(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_admin_user)
@@ -579,7 +2453,7 @@ async def get_pending_vendors(
     ).all()
     return vendors
 
-@app.put("/admin/vendors/{vendor_id}/verify", tags=["Admin - Vendors"])
+@router.put("/admin/vendors/{vendor_id}/verify", tags=["Admin - Vendors"])
 async def verify_vendor(
     vendor_id: int,
     db: Session = Depends(get_db),
@@ -597,7 +2471,7 @@ async def verify_vendor(
     return {"message": "Vendor verified successfully"}
 
 # ==================== VENDOR ENDPOINTS ====================
-@app.post("/vendor/products", response_model=ProductResponse, tags=["Vendor - Products"])
+@router.post("/vendor/products", response_model=ProductResponse, tags=["Vendor - Products"])
 async def create_product(
     product: ProductCreate,
     db: Session = Depends(get_db),
@@ -613,11 +2487,14 @@ async def create_product(
         status=ProductStatus.PENDING if current_user.role == UserRole.VENDOR else ProductStatus.APPROVED
     )
     db.add(db_product)
+    db.flush()
+    sync_catalog_product(db, db_product.id)
+    catalog_cache.invalidate(db)
     db.commit()
     db.refresh(db_product)
     return db_product
 
-@app.put("/vendor/products/{product_id}", response_model=ProductResponse, tags=["Vendor - Products"])
+@router.put("/vendor/products/{product_id}", response_model=ProductResponse, tags=["Vendor - Products"])
 async def update_product(
     product_id: int,
     product: ProductUpdate,
@@ -632,14 +2509,24 @@ async def update_product(
     if current_user.role == UserRole.VENDOR and db_product.vendor_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to edit this product")
     
-    for key, value in product.dict(exclude_unset=True).items():
+    changes = product.dict(exclude_unset=True)
+    on_hand = changes.pop("stock", None)
+    for key, value in changes.items():
         setattr(db_product, key, value)
+    if on_hand is not None:
+        # The vendor counts units on hand: those held by carts and pending orders are not available
+        db.flush()
+        if set_stock_on_hand(db, product_id, on_hand) is None:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Stock is lower than the quantity currently reserved")
+    sync_catalog_product(db, product_id)
     
+    catalog_cache.invalidate(db)
     db.commit()
     db.refresh(db_product)
     return db_product
 
-@app.delete("/vendor/products/{product_id}", tags=["Vendor - Products"])
+@router.delete("/vendor/products/{product_id}", tags=["Vendor - Products"])
 async def delete_product(
     product_id: int,
     db: Session = Depends(get_db),
@@ -654,10 +2541,12 @@ async def delete_product(
         raise HTTPException(status_code=403, detail="Not authorized to delete this product")
     
     db.delete(db_product)
+    sync_catalog_product(db, product_id)
+    catalog_cache.invalidate(db)
     db.commit()
     return {"message": "Product deleted successfully"}
 
-@app.put("/vendor/location", tags=["Vendor - Profile"])
+@router.put("/vendor/location", tags=["Vendor - Profile"])
 async def update_vendor_location(
     latitude: float,
     longitude: float,
@@ -670,59 +2559,154 @@ async def update_vendor_location(
     db.commit()
     return {"message": "Location updated successfully"}
 
-@app.get("/vendor/sales", tags=["Vendor - Sales"])
+@router.get("/vendor/sales", tags=["Vendor - Sales"])
 async def get_vendor_sales(
+    include_archived: bool = False,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_vendor_user)
 ):
     """Historique des ventes du vendeur"""
+    if include_archived:
+        items = history_table(OrderItem.__table__)
+        rows = db.execute(
+            select(items).join(Product, Product.id == items.c.product_id)
+            .where(Product.vendor_id == current_user.id)
+        ).mappings()
+        return [dict(row) for row in rows]
     sales = db.query(OrderItem).join(Product).filter(
         Product.vendor_id == current_user.id
     ).all()
     return sales
 
 # ==================== PUBLIC ENDPOINTS ====================
-@app.get("/categories", response_model=List[CategoryResponse], tags=["Public - Categories"])
-async def get_categories(db: Session = Depends(get_db)):
-    """Liste de toutes les catégories"""
-    categories = db.query(Category).all()
-    return categories
-
-@app.get("/products", response_model=List[ProductResponse], tags=["Public - Products"])
+@router.get("/categories", response_model=List[CategoryStatsResponse], tags=["Public - Categories"])
+async def get_categories(request: Request, db: Session = Depends(get_db)):
+    """Liste de toutes les catégories avec nombre de produits et fourchette de prix"""
+    def build():
+        rows = db.query(
+            Category.id, Category.name, Category.description,
+            func.coalesce(CategoryStats.product_count, 0).label("product_count"),
+            CategoryStats.min_price, CategoryStats.max_price
+        ).outerjoin(CategoryStats, CategoryStats.category_id == Category.id).all()
+        return CATEGORY_LIST_ADAPTER.dump_json([CategoryStatsResponse.model_validate(row) for row in rows])
+
+    return catalog_response(request, db, ("categories",), build)
+
+@router.get("/products", response_model=List[CatalogProductResponse], tags=["Public - Products"])
 async def get_products(
+    request: Request,
     category_id: Optional[int] = None,
+    vendor_id: Optional[int] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
     db: Session = Depends(get_db)
 ):
-    """Liste des produits approuvés (avec filtre optionnel par catégorie)"""
-    query = db.query(Product).filter(Product.status == ProductStatus.APPROVED)
-    if category_id:
-        query = query.filter(Product.category_id == category_id)
-    products = query.all()
-    return products
-
-@app.get("/products/{product_id}", response_model=ProductResponse, tags=["Public - Products"])
+    """Liste des produits approuvés (filtres optionnels par catégorie, vendeur et prix)"""
+    def build():
+        query = db.query(CatalogProduct)
+        if category_id:
+            query = query.filter(CatalogProduct.category_id == category_id)
+        if vendor_id:
+            query = query.filter(CatalogProduct.vendor_id == vendor_id)
+        if min_price is not None:
+            query = query.filter(CatalogProduct.price >= min_price)
+        if max_price is not None:
+            query = query.filter(CatalogProduct.price <= max_price)
+        products = query.order_by(CatalogProduct.id).all()
+        return PRODUCT_LIST_ADAPTER.dump_json([CatalogProductResponse.model_validate(p) for p in products])
+
+    key = ("products", category_id or None, vendor_id or None, min_price, max_price)
+    return catalog_response(request, db, key, build)
+
+def find_nearby_products(db: Session, latitude: float, longitude: float, radius_km: float, limit: int, offset: int):
+    """Produits approuvés des vendeurs situés à moins de radius_km, triés par distance"""
+    lat_min, lat_max, lon_min, lon_max = bounding_box(latitude, longitude, radius_km)
+    if lon_min < -180 or lon_max > 180:
+        # The box crosses the antimeridian: split it in two longitude ranges
+        lon_filter = or_(
+            User.longitude >= (lon_min + 360 if lon_min < -180 else lon_min),
+            User.longitude <= (lon_max - 360 if lon_max > 180 else lon_max)
+        )
+    else:
+        lon_filter = User.longitude.between(lon_min, lon_max)
+
+    # Index range scan on (latitude, longitude), then exact distance once per vendor
+    vendors = db.query(User.id, User.latitude, User.longitude).filter(
+        User.latitude.between(lat_min, lat_max),
+        lon_filter,
+        User.role == UserRole.VENDOR,
+        User.is_active == True
+    ).all()
+    distances = {}
+    for vendor_id, vendor_latitude, vendor_longitude in vendors:
+        distance = calculate_distance(latitude, longitude, vendor_latitude, vendor_longitude)
+        if distance <= radius_km:
+            distances[vendor_id] = distance
+    if not distances:
+        return []
+
+    candidates = db.query(Product.id, Product.vendor_id).filter(
+        Product.vendor_id.in_(distances),
+        Product.status == ProductStatus.APPROVED
+    ).all()
+    candidates.sort(key=lambda row: (distances[row.vendor_id], row.id))
+    page = candidates[offset:offset + limit]
+
+    products = {p.id: p for p in db.query(Product).filter(Product.id.in_([row.id for row in page]))}
+    return [(products[row.id], distances[row.vendor_id]) for row in page]
+
+@router.get("/products/nearby", response_model=List[NearbyProductResponse], tags=["Public - Products"])
+async def get_nearby_products(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    radius_km: float = Query(5, gt=0, le=100),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """Produits approuvés des vendeurs proches, du plus proche au plus éloigné"""
+    return [
+        NearbyProductResponse(
+            **ProductResponse.model_validate(product).model_dump(),
+            distance_km=round(distance, 3)
+        )
+        for product, distance in find_nearby_products(db, lat, lon, radius_km, limit, offset)
+    ]
+
+@router.get("/products/{product_id}", response_model=ProductResponse, tags=["Public - Products"])
 async def get_product(product_id: int, db: Session = Depends(get_db)):
     """Détails d'un produit"""
-    product = db.query(Product).filter(
-        Product.id == product_id,
-        Product.status == ProductStatus.APPROVED
-    ).first()
+    product = db.query(Product).filter(Product.id == product_id, sellable_products()).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
 
 # ==================== CART ENDPOINTS ====================
-@app.post("/cart", response_model=CartItemResponse, tags=["Public - Cart"])
-async def add_to_cart(
-    session_id: str,
-    item: CartItemCreate,
-    db: Session = Depends(get_db)
-):
-    """Ajouter un produit au panier"""
-    product = db.query(Product).filter(Product.id == item.product_id).first()
+def reserve_cart_item(db: Session, session_id: str, item: CartItemCreate) -> CartItem:
+    product = db.query(Product).filter(Product.id == item.product_id, sellable_products()).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    # No catalog version bump here: it would make every reservation write the same row.
+    # Listed stock follows through the inventory sweep.
+    if not take_stock(db, item.product_id, item.quantity):
+        db.rollback()
+        STOCK_RESERVATIONS.labels(result="insufficient").inc()
+        raise HTTPException(status_code=409, detail="Insufficient stock")
+    expires_at = utcnow() + timedelta(seconds=CART_RESERVATION_SECONDS)
+    # Any activity keeps the whole cart reserved
+    db.query(StockReservation).filter(
+        StockReservation.session_id == session_id,
+        StockReservation.order_id.is_(None)
+    ).update({StockReservation.expires_at: expires_at}, synchronize_session=False)
+    db.add(StockReservation(
+        session_id=session_id,
+        product_id=item.product_id,
+        quantity=item.quantity,
+        expires_at=expires_at
+    ))
+    STOCK_RESERVATIONS.labels(result="reserved").inc()
+    
     # Check if item already in cart
     cart_item = db.query(CartItem).filter(
         CartItem.session_id == session_id,
@@ -743,13 +2727,23 @@ async def add_to_cart(
     db.refresh(cart_item)
     return cart_item
 
-@app.get("/cart/{session_id}", response_model=List[CartItemResponse], tags=["Public - Cart"])
+@router.post("/cart", response_model=CartItemResponse, tags=["Public - Cart"])
+async def add_to_cart(
+    session_id: str,
+    item: CartItemCreate,
+    db: Session = Depends(get_db)
+):
+    """Ajouter un produit au panier en réservant le stock pendant CART_RESERVATION_SECONDS"""
+    # Buyers of a hot product queue on the same rows: wait for the database outside the event loop
+    return await run_in_threadpool(reserve_cart_item, db, session_id, item)
+
+@router.get("/cart/{session_id}", response_model=List[CartItemResponse], tags=["Public - Cart"])
 async def get_cart(session_id: str, db: Session = Depends(get_db)):
     """Voir le panier"""
     cart_items = db.query(CartItem).filter(CartItem.session_id == session_id).all()
     return cart_items
 
-@app.delete("/cart/{session_id}/{item_id}", tags=["Public - Cart"])
+@router.delete("/cart/{session_id}/{item_id}", tags=["Public - Cart"])
 async def remove_from_cart(session_id: str, item_id: int, db: Session = Depends(get_db)):
     """Supprimer un article du panier"""
     cart_item = db.query(CartItem).filter(
@@ -758,14 +2752,23 @@ async def remove_from_cart(session_id: str, item_id: int, db: Session = Depends(
     ).first()
     if not cart_item:
         raise HTTPException(status_code=404, detail="Cart item not found")
+    reservations = db.query(StockReservation).filter(
+        StockReservation.session_id == session_id,
+        StockReservation.product_id == cart_item.product_id,
+        StockReservation.order_id.is_(None)
+    ).all()
+    for reservation in reservations:
+        give_back_stock(db, reservation.product_id, reservation.quantity)
+        STOCK_RELEASED.labels(reason="removed").inc(reservation.quantity)
+        db.delete(reservation)
     db.delete(cart_item)
     db.commit()
     return {"message": "Item removed from cart"}
 
 # ==================== ORDER ENDPOINTS ====================
-@app.post("/orders", response_model=OrderResponse, tags=["Public - Orders"])
+@router.post("/orders", response_model=OrderResponse, tags=["Public - Orders"])
 async def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
-    """Créer une commande à partir du panier"""
+    """Créer une commande à partir du panier ; le stock reste réservé CHECKOUT_RESERVATION_SECONDS pour le paiement"""
     # Get cart items
     cart_items = db.query(CartItem).filter(
         CartItem.session_id == order_data.session_id
@@ -773,6 +2776,12 @@ async def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
     
     if not cart_items:
         raise HTTPException(status_code=400, detail="Cart is empty")
+    sellable = {row[0] for row in db.query(Product.id).filter(
+        Product.id.in_([item.product_id for item in cart_items]), sellable_products()
+    )}
+    for cart_item in cart_items:
+        if cart_item.product_id not in sellable:
+            raise HTTPException(status_code=409, detail=f"Product {cart_item.product_id} is no longer available")
     
     # Calculate total
     total = sum(item.product.price * item.quantity for item in cart_items)
@@ -791,8 +2800,36 @@ async def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
         status=OrderStatus.PENDING
     )
     db.add(order)
-    db.commit()
-    db.refresh(order)
+    db.flush()
+
+    # Move the cart reservations to the order, then reserve again what the sweep released
+    expires_at = utcnow() + timedelta(seconds=CHECKOUT_RESERVATION_SECONDS)
+    db.query(StockReservation).filter(
+        StockReservation.session_id == order_data.session_id,
+        StockReservation.order_id.is_(None)
+    ).update({
+        StockReservation.order_id: order.id,
+        StockReservation.expires_at: expires_at,
+    }, synchronize_session=False)
+    reserved = dict(db.query(StockReservation.product_id, func.sum(StockReservation.quantity)).filter(
+        StockReservation.order_id == order.id
+    ).group_by(StockReservation.product_id).all())
+    for cart_item in cart_items:
+        missing = cart_item.quantity - reserved.get(cart_item.product_id, 0)
+        if missing <= 0:
+            continue
+        if not take_stock(db, cart_item.product_id, missing):
+            db.rollback()
+            STOCK_RESERVATIONS.labels(result="insufficient").inc()
+            raise HTTPException(status_code=409, detail=f"Insufficient stock for product {cart_item.product_id}")
+        db.add(StockReservation(
+            session_id=order_data.session_id,
+            product_id=cart_item.product_id,
+            quantity=missing,
+            order_id=order.id,
+            expires_at=expires_at
+        ))
+        STOCK_RESERVATIONS.labels(result="reserved").inc()
     
     # Create order items
     for cart_item in cart_items:
@@ -808,6 +2845,7 @@ async def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
     db.query(CartItem).filter(CartItem.session_id == order_data.session_id).delete()
     
     db.commit()
+    db.refresh(order)
 
     ORDERS_CREATED.inc()
     ORDER_TOTAL_AMOUNT.observe(total)
@@ -821,74 +2859,219 @@ async def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
 
     return order
 
-@app.post("/orders/{order_id}/payment", tags=["Public - Orders"])
+def find_closest_driver(db: Session, latitude: float, longitude: float):
+    """Livreur actif le plus proche d'un point, avec sa position"""
+    delivery_persons = db.query(User.id, User.latitude, User.longitude).filter(
+        User.role == UserRole.DELIVERY,
+        User.is_active == True
+    ).all()
+    
+    closest_delivery = None
+    min_distance = float('inf')
+    
+    for delivery in delivery_persons:
+        # Live position from the location store, last flushed position otherwise
+        position = driver_locations.get(delivery.id)
+        driver_latitude, driver_longitude = position[:2] if position else (delivery.latitude, delivery.longitude)
+        if driver_latitude and driver_longitude:
+            distance = calculate_distance(driver_latitude, driver_longitude, latitude, longitude)
+            if distance < min_distance:
+                min_distance = distance
+                closest_delivery = (delivery.id, (driver_latitude, driver_longitude))
+    return closest_delivery
+
+@job_handler("assign_delivery")
+def assign_delivery(db: Session, payload: dict) -> Optional[list]:
+    """Regrouper une commande payée avec les commandes voisines et les assigner en tournée au livreur le plus proche"""
+    order = db.query(Order).filter(Order.id == payload["order_id"]).first()
+    # The job may be retried after a crash: only a PAID order still needs a driver
+    if not order or order.status != OrderStatus.PAID:
+        return
+
+    start_time = time.perf_counter()
+    # Vendor locations of the oldest unassigned paid orders (the seed order first)
+    rows = db.query(
+        Order.id, Order.client_latitude, Order.client_longitude,
+        User.id, User.latitude, User.longitude
+    ).join(OrderItem, OrderItem.order_id == Order.id).join(
+        Product, Product.id == OrderItem.product_id
+    ).join(User, User.id == Product.vendor_id).filter(
+        Order.status == OrderStatus.PAID,
+        Order.id.in_(
+            db.query(Order.id).filter(Order.status == OrderStatus.PAID)
+            .order_by(Order.id).limit(ROUTE_CANDIDATE_LIMIT).scalar_subquery()
+        ) | (Order.id == order.id)
+    ).order_by(Order.id, OrderItem.id).all()
+
+    vendors_by_order = {}
+    clients = {}
+    for order_id, client_latitude, client_longitude, vendor_id, latitude, longitude in rows:
+        clients[order_id] = (client_latitude, client_longitude)
+        vendors = vendors_by_order.setdefault(order_id, {})
+        vendors[vendor_id] = (latitude, longitude)
+
+    def located(order_id):
+        return (
+            None not in clients[order_id]
+            and all(latitude and longitude for latitude, longitude in vendors_by_order[order_id].values())
+        )
+
+    # Same simplification as before: an order is matched through its first vendor
+    if order.id not in vendors_by_order or not located(order.id):
+        return
+    candidates = [
+        (order_id, next(iter(vendors_by_order[order_id].values())), clients[order_id])
+        for order_id in [order.id] + [o for o in vendors_by_order if o != order.id]
+        if located(order_id)
+    ]
+    batch = group_orders(candidates)[0]
+
+    driver = find_closest_driver(db, *batch[0][1])
+    if driver is None:
+        return
+    driver_id, driver_position = driver
+
+    pickups = [
+        (order_id, vendor_id, position)
+        for order_id, _, _ in batch
+        for vendor_id, position in vendors_by_order[order_id].items()
+    ]
+    stops, length = plan_route(driver_position, [p[2] for p in pickups], [b[2] for b in batch])
+    ROUTE_PLANNING_DURATION_MS.observe((time.perf_counter() - start_time) * 1000)
+
+    order_ids = [order_id for order_id, _, _ in batch]
+    assigned = db.query(Order).filter(
+        Order.id.in_(order_ids),
+        Order.status == OrderStatus.PAID
+    ).update({
+        Order.delivery_person_id: driver_id,
+        Order.status: OrderStatus.ASSIGNED,
+    }, synchronize_session=False)
+    if assigned != len(order_ids):
+        # Another worker assigned some of these orders meanwhile: plan again later
+        db.rollback()
+        raise RuntimeError("Orders of the batch were assigned concurrently")
+
+    route = DeliveryRoute(delivery_person_id=driver_id, total_distance_km=round(length, 3))
+    db.add(route)
+    db.flush()
+    for sequence, (kind, index) in enumerate(stops, start=1):
+        if kind == StopKind.PICKUP:
+            order_id, vendor_id, (latitude, longitude) = pickups[index]
+        else:
+            order_id, vendor_id, (latitude, longitude) = batch[index][0], None, batch[index][2]
+        db.add(RouteStop(
+            route_id=route.id,
+            sequence=sequence,
+            kind=kind,
+            order_id=order_id,
+            vendor_id=vendor_id,
+            latitude=latitude,
+            longitude=longitude
+        ))
+    db.commit()
+    ROUTE_ORDERS.observe(len(order_ids))
+
+    events = []
+    for assigned_order in db.query(Order).filter(Order.id.in_(order_ids)).all():
+        events.append((f"order:{assigned_order.id}", order_status_event(assigned_order)))
+        events.append((f"driver:{driver_id}", {
+            "event": "order_assigned",
+            "order_id": assigned_order.id,
+            "order_number": assigned_order.order_number,
+            "client_address": assigned_order.client_address,
+            "client_latitude": assigned_order.client_latitude,
+            "client_longitude": assigned_order.client_longitude,
+            "route_id": route.id,
+        }))
+
+    logger.info(json.dumps({
+        "event": "route_assigned",
+        "route_id": route.id,
+        "order_ids": order_ids,
+        "delivery_person_id": driver_id,
+        "total_distance_km": route.total_distance_km
+    }))
+    return events
+
+@router.post("/orders/{order_id}/payment", tags=["Public - Orders"])
 async def process_payment(
     order_id: int,
     payment_reference: str,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
     db: Session = Depends(get_db)
 ):
-    """Traiter le paiement Fedapay et assigner un livreur"""
+    """Enregistrer le paiement Fedapay ; l'assignation du livreur est faite en arrière-plan"""
+    fingerprint = request_fingerprint(request)
+    if idempotency_key:
+        replay = find_idempotent_response(db, idempotency_key, fingerprint)
+        if replay is not None:
+            return replay
+
     order = db.query(Order).filter(Order.id == order_id).first()
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    # TODO: Intégrer vraiment Fedapay ici
-    order.payment_reference = payment_reference
-    order.status = OrderStatus.PAID
-    order.paid_at = datetime.now(timezone.utc)
-    ORDERS_PAID.inc()
-    
-    # Find closest delivery person
-    order_items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
-    vendor_ids = set(item.product.vendor_id for item in order_items)
-    
-    # Get average vendor location (simplified - prendre le premier vendeur)
-    first_vendor = db.query(User).filter(User.id == list(vendor_ids)[0]).first()
-    
-    if first_vendor and first_vendor.latitude and first_vendor.longitude:
-        # Find closest delivery person
-        delivery_persons = db.query(User).filter(
-            User.role == UserRole.DELIVERY,
-            User.is_active == True
-        ).all()
-        
-        closest_delivery = None
-        min_distance = float('inf')
-        
-        for delivery in delivery_persons:
-            if delivery.latitude and delivery.longitude:
-                distance = calculate_distance(
-                    first_vendor.latitude,
-                    first_vendor.longitude,
-                    order.client_latitude,
-                    order.client_longitude
-                )
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_delivery = delivery
-        
-        if closest_delivery:
-            order.delivery_person_id = closest_delivery.id
-            order.status = OrderStatus.ASSIGNED
-    
-    db.commit()
+    # TODO: Intégrer vraiment Fedapay ici (appel fournisseur à exécuter dans un job)
+    # Guarded transition: only one concurrent request can move the order out of PENDING
+    paid = db.query(Order).filter(
+        Order.id == order_id,
+        Order.status == OrderStatus.PENDING
+    ).update({
+        Order.payment_reference: payment_reference,
+        Order.status: OrderStatus.PAID,
+        Order.paid_at: datetime.now(timezone.utc),
+    }, synchronize_session=False)
+
+    if paid:
+        # The reserved stock is now sold
+        db.query(StockReservation).filter(StockReservation.order_id == order_id).delete(synchronize_session=False)
+        # Delayed so that orders paid in the same window can share a route
+        enqueue_job(db, "assign_delivery", {"order_id": order_id}, delay_seconds=ROUTE_BATCH_WINDOW_SECONDS)
+        response = {"message": "Payment processed, delivery assignment queued", "order_id": order_id}
+    else:
+        db.refresh(order)
+        if order.payment_reference != payment_reference:
+            raise HTTPException(status_code=409, detail=f"Order is already {order.status.value}")
+        response = {"message": "Payment already processed", "order_id": order_id}
 
-    logger.info(json.dumps({
-        "event": "order_paid",
-        "order_id": order.id,
-        "payment_reference": payment_reference
-    }))
+    if idempotency_key:
+        store_idempotent_response(db, idempotency_key, fingerprint, response)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Same key committed by a concurrent request in the meantime
+        db.rollback()
+        replay = find_idempotent_response(db, idempotency_key, fingerprint)
+        if replay is None:
+            raise
+        return replay
+
+    if paid:
+        job_wakeup.set()
+        ORDERS_PAID.inc()
+        db.refresh(order)
+        await event_broker.publish(f"order:{order.id}", order_status_event(order))
+
+        logger.info(json.dumps({
+            "event": "order_paid",
+            "order_id": order.id,
+            "payment_reference": payment_reference
+        }))
 
-    return {"message": "Payment processed and delivery assigned", "order_id": order.id}
+    return response
 
-@app.get("/orders/global-sales", tags=["Public - Statistics"])
-async def get_global_sales(db: Session = Depends(get_db)):
+@router.get("/orders/global-sales", tags=["Public - Statistics"])
+async def get_global_sales(include_archived: bool = False, db: Session = Depends(get_db)):
     """Historique global des ventes"""
+    if include_archived:
+        return [dict(row) for row in db.execute(select(history_table(OrderItem.__table__))).mappings()]
     sales = db.query(OrderItem).all()
     return sales
 
 # ==================== DELIVERY ENDPOINTS ====================
-@app.get("/delivery/orders", tags=["Delivery - Orders"])
+@router.get("/delivery/orders", tags=["Delivery - Orders"])
 async def get_assigned_deliveries(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
@@ -903,7 +3086,60 @@ async def get_assigned_deliveries(
     ).all()
     return orders
 
-@app.put("/delivery/orders/{order_id}/status", tags=["Delivery - Orders"])
+@router.get("/delivery/routes", tags=["Delivery - Orders"])
+async def get_assigned_routes(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Tournées du livreur avec leurs arrêts restants, dans l'ordre de passage"""
+    if current_user.role != UserRole.DELIVERY:
+        raise HTTPException(status_code=403, detail="Delivery person only")
+
+    stops = db.query(RouteStop, DeliveryRoute).join(
+        DeliveryRoute, DeliveryRoute.id == RouteStop.route_id
+    ).join(Order, Order.id == RouteStop.order_id).filter(
+        DeliveryRoute.delivery_person_id == current_user.id,
+        Order.delivery_person_id == current_user.id,
+        # Assigned orders still need both stops; once picked up, only the drop-off remains
+        or_(
+            Order.status == OrderStatus.ASSIGNED,
+            and_(Order.status == OrderStatus.IN_DELIVERY, RouteStop.kind == StopKind.DROPOFF)
+        )
+    ).order_by(DeliveryRoute.id, RouteStop.sequence).all()
+
+    routes = {}
+    for stop, route in stops:
+        routes.setdefault(route.id, {
+            "id": route.id,
+            "total_distance_km": route.total_distance_km,
+            "created_at": route.created_at,
+            "stops": [],
+        })["stops"].append({
+            "sequence": stop.sequence,
+            "kind": stop.kind,
+            "order_id": stop.order_id,
+            "vendor_id": stop.vendor_id,
+            "latitude": stop.latitude,
+            "longitude": stop.longitude,
+        })
+    return list(routes.values())
+
+@router.post("/delivery/location", tags=["Delivery - Location"])
+async def update_delivery_location(
+    batch: LocationBatch,
+    current_user: User = Depends(get_current_user)
+):
+    """Envoyer un lot de positions GPS du livreur"""
+    if current_user.role != UserRole.DELIVERY:
+        raise HTTPException(status_code=403, detail="Delivery person only")
+
+    for point in batch.points:
+        recorded_at = point.recorded_at.timestamp() if point.recorded_at else None
+        driver_locations.record(current_user.id, point.latitude, point.longitude, recorded_at)
+    LOCATION_POINTS_INGESTED.inc(len(batch.points))
+    return {"accepted": len(batch.points)}
+
+@router.put("/delivery/orders/{order_id}/status", tags=["Delivery - Orders"])
 async def update_delivery_status(
     order_id: int,
     new_status: OrderStatus,
@@ -927,9 +3163,177 @@ async def update_delivery_status(
         order.delivered_at = datetime.now(timezone.utc)
     
     db.commit()
+    await event_broker.publish(f"order:{order.id}", order_status_event(order))
     return {"message": "Status updated successfully"}
 
+# ==================== REALTIME ENDPOINTS ====================
+WEBSOCKET_AUTH_PROTOCOL = "bearer"
+
+def websocket_token(websocket: WebSocket) -> Optional[str]:
+    """Token JWT transmis dans Sec-WebSocket-Protocol (« bearer, <token> ») plutôt que dans l'URL"""
+    protocols = websocket.scope.get("subprotocols") or []
+    if len(protocols) == 2 and protocols[0] == WEBSOCKET_AUTH_PROTOCOL:
+        return protocols[1]
+    return None
+
+@router.websocket("/ws/delivery")
+async def delivery_channel(websocket: WebSocket):
+    """Canal temps réel du livreur : envoi de position, réception des assignations"""
+    # A token in the query string would end up in access logs and proxy logs
+    token = websocket_token(websocket)
+    if token is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    db = SessionLocal()
+    try:
+        user = get_user_from_token(token, db)
+        if user is None or user.role != UserRole.DELIVERY:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        driver_id = user.id
+        active_orders = {
+            order_id for (order_id,) in db.query(Order.id).filter(
+                Order.delivery_person_id == driver_id,
+                Order.status.in_([OrderStatus.ASSIGNED, OrderStatus.IN_DELIVERY])
+            )
+        }
+    finally:
+        db.close()
+
+    await websocket.accept(subprotocol=WEBSOCKET_AUTH_PROTOCOL)
+    queue = event_broker.subscribe(f"driver:{driver_id}")
+    REALTIME_CONNECTIONS.labels(channel="delivery").inc()
+
+    async def forward_events():
+        while True:
+            event = event_payload(await queue.get())
+            if event["event"] == "order_assigned":
+                active_orders.add(event["order_id"])
+            await websocket.send_json(event)
+
+    forwarder = asyncio.create_task(forward_events())
+    try:
+        while True:
+            try:
+                location = LocationUpdate(**await websocket.receive_json())
+            except (ValueError, TypeError):
+                await websocket.send_json({"event": "error", "detail": "Invalid location"})
+                continue
+
+            driver_locations.record(driver_id, location.latitude, location.longitude)
+            LOCATION_POINTS_INGESTED.inc()
+            for order_id in active_orders:
+                await event_broker.publish(f"order:{order_id}", {
+                    "event": "driver_location",
+                    "order_id": order_id,
+                    "latitude": location.latitude,
+                    "longitude": location.longitude,
+                })
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forwarder.cancel()
+        event_broker.unsubscribe(queue)
+        REALTIME_CONNECTIONS.labels(channel="delivery").dec()
+
+@router.get("/orders/{order_id}/events", tags=["Public - Orders"])
+async def order_events(
+    order_id: int,
+    client_email: EmailStr,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Suivre en temps réel le statut d'une commande (Server-Sent Events)"""
+    order = db.query(Order).filter(
+        Order.id == order_id,
+        Order.client_email == client_email
+    ).first()
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    db.close()
+
+    def load_snapshot():
+        db = SessionLocal()
+        try:
+            return order_status_event(db.get(Order, order_id))
+        finally:
+            db.close()
+
+    async def stream():
+        # Subscribed only once the stream runs, so a client gone before the first byte leaves nothing behind
+        queue = event_broker.subscribe(f"order:{order_id}")
+        REALTIME_CONNECTIONS.labels(channel="order").inc()
+        try:
+            # Read after subscribing: a status change in between is either in the snapshot or in the queue
+            event = await run_in_threadpool(load_snapshot)
+            while True:
+                yield f"data: {json.dumps(event)}\n\n"
+                if event.get("status") in (OrderStatus.DELIVERED, OrderStatus.CANCELLED):
+                    return
+                event = None
+                while event is None:
+                    try:
+                        event = event_payload(
+                            await asyncio.wait_for(queue.get(), timeout=REALTIME_HEARTBEAT_SECONDS)
+                        )
+                    except asyncio.TimeoutError:
+                        if await request.is_disconnected():
+                            return
+                        yield ": keep-alive\n\n"
+        finally:
+            event_broker.unsubscribe(queue)
+            REALTIME_CONNECTIONS.labels(channel="order").dec()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ==================== HEALTH CHECK ====================
-@app.get("/", tags=["Health"])
+@router.get("/", tags=["Health"])
 async def root():
     return {"message": "E-commerce API is running", "version": "1.0.0"}
+
+# ==================== APP FACTORY ====================
+def create_app() -> FastAPI:
+    app = FastAPI(
+        title="E-commerce API",
+        description="API REST pour plateforme e-commerce avec vendeurs, livreurs et admins",
+        version="1.0.0",
+        lifespan=lifespan
+    )
+
+    # Added first so that it wraps the router directly and sees whole bodies
+    app.add_middleware(CompressionMiddleware)
+    app.middleware("http")(request_logging_middleware)
+    # Outside the logging middleware so that rejected requests cost as little as possible
+    app.add_middleware(AdmissionControlMiddleware)
+
+    instrumentator = Instrumentator(
+        should_group_status_codes=False,
+        should_ignore_untemplated=True,
+        should_respect_env_var=False,
+        should_instrument_requests_inprogress=True,
+        excluded_handlers=["/metrics"],
+        inprogress_name="inprogress",
+        inprogress_labels=True
+    )
+
+    instrumentator.instrument(app)
+
+    instrumentator.expose(
+        app,
+        endpoint="/metrics",
+        dependencies=[Depends(basic_auth)]
+    )
+
+    app.include_router(router)
+    return app
+
+def __getattr__(name):
+    # Keeps `uvicorn main:app` working: the application is built on first access only
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
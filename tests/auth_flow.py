@@ -9,11 +9,17 @@ import requests
 
 
 SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL", None)
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
-Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+
+@pytest.fixture(scope="module")
+def database():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    TestingSessionLocal.configure(bind=engine)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
 
 
 def generate_password(length: int = 32) -> str:
@@ -22,7 +28,7 @@ def generate_password(length: int = 32) -> str:
 
 
 @pytest.fixture(scope="module")
-def create_admin_user():
+def create_admin_user(database):
     db = TestingSessionLocal()
     password = generate_password()
     user = User(
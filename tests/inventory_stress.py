@@ -0,0 +1,165 @@
+import os
+import time
+import uuid
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+from main import Category, Product, ProductStatus, StockReservation, StockShard, User, UserRole, get_password_hash, set_stock_shards
+
+
+SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL", None)
+API_URL = os.environ.get("API_URL", "http://localhost:80")
+STOCK = 100
+BUYERS = 400
+THREADS = 32
+RETRY_SECONDS = 120
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+@pytest.fixture(scope="module")
+def database():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    TestingSessionLocal.configure(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def vendor(database):
+    db = TestingSessionLocal()
+    suffix = uuid.uuid4().hex[:8]
+    user = User(
+        email=f"stress_vendor_{suffix}@test.com",
+        username=f"stress_vendor_{suffix}",
+        hashed_password="-",
+        role=UserRole.VENDOR,
+        is_active=True,
+        is_verified=True
+    )
+    category = Category(name=f"stress_{suffix}")
+    db.add_all([user, category])
+    db.commit()
+    ids = (user.id, category.id)
+    db.close()
+    return ids
+
+
+@pytest.fixture(scope="module")
+def vendor_headers(vendor):
+    password = uuid.uuid4().hex
+    db = TestingSessionLocal()
+    user = db.get(User, vendor[0])
+    user.hashed_password = get_password_hash(password)
+    username = user.username
+    db.commit()
+    db.close()
+    response = requests.post(f"{API_URL}/token", data={"username": username, "password": password}, timeout=30)
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def create_product(vendor, shards: int) -> int:
+    vendor_id, category_id = vendor
+    db = TestingSessionLocal()
+    product = Product(
+        name="Flash sale",
+        price=1000,
+        stock=STOCK,
+        status=ProductStatus.APPROVED,
+        category_id=category_id,
+        vendor_id=vendor_id
+    )
+    db.add(product)
+    db.commit()
+    set_stock_shards(db, product.id, shards)
+    db.commit()
+    product_id = product.id
+    db.close()
+    return product_id
+
+
+def buy(product_id: int, quantity: int) -> tuple:
+    session = requests.Session()
+    session_id = uuid.uuid4().hex
+    deadline = time.monotonic() + RETRY_SECONDS
+    while True:
+        response = session.post(
+            f"{API_URL}/cart",
+            params={"session_id": session_id},
+            json={"product_id": product_id, "quantity": quantity},
+            timeout=30
+        )
+        # Admission control may shed load: back off and retry, it is not a stock decision
+        if response.status_code not in (429, 503) or time.monotonic() > deadline:
+            return response.status_code, quantity
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize("shards", [1, 8])
+def test_no_overselling_under_concurrent_reservations(vendor, shards):
+    product_id = create_product(vendor, shards)
+    quantities = [1 + i % 3 for i in range(BUYERS)]
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        results = list(pool.map(lambda q: buy(product_id, q), quantities))
+
+    statuses = {status for status, _ in results}
+    assert statuses <= {200, 409}, statuses
+    sold = sum(quantity for status, quantity in results if status == 200)
+
+    db = TestingSessionLocal()
+    reserved = sum(r.quantity for r in db.query(StockReservation).filter(StockReservation.product_id == product_id))
+    if shards > 1:
+        left = sum(s.stock for s in db.query(StockShard).filter(StockShard.product_id == product_id))
+        assert all(s.stock >= 0 for s in db.query(StockShard).filter(StockShard.product_id == product_id))
+    else:
+        left = db.query(Product.stock).filter(Product.id == product_id).scalar()
+    db.close()
+
+    # Demand is four times the stock: every unit is reserved once and only once
+    assert sold == reserved
+    assert left >= 0
+    assert sold + left == STOCK
+    assert left < 3
+
+
+def available_stock(product_id: int) -> int:
+    db = TestingSessionLocal()
+    shards = [s.stock for s in db.query(StockShard).filter(StockShard.product_id == product_id)]
+    stock = sum(shards) if shards else db.query(Product.stock).filter(Product.id == product_id).scalar()
+    db.close()
+    return stock
+
+
+@pytest.mark.parametrize("shards", [1, 8])
+def test_vendor_stock_includes_reserved_units(vendor, vendor_headers, shards):
+    product_id = create_product(vendor, shards)
+    session_id = uuid.uuid4().hex
+    response = requests.post(
+        f"{API_URL}/cart",
+        params={"session_id": session_id},
+        json={"product_id": product_id, "quantity": 3},
+        timeout=30
+    )
+    assert response.status_code == 200, response.text
+    item_id = response.json()["id"]
+
+    # 3 units are held by the cart: 7 on hand leaves 4 available
+    response = requests.put(
+        f"{API_URL}/vendor/products/{product_id}", json={"stock": 7}, headers=vendor_headers, timeout=30
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["stock"] == 4
+    assert available_stock(product_id) == 4
+
+    response = requests.put(
+        f"{API_URL}/vendor/products/{product_id}", json={"stock": 2}, headers=vendor_headers, timeout=30
+    )
+    assert response.status_code == 409
+
+    # Released units come back up to the vendor's figure, not beyond
+    response = requests.delete(f"{API_URL}/cart/{session_id}/{item_id}", timeout=30)
+    assert response.status_code == 200, response.text
+    assert available_stock(product_id) == 7
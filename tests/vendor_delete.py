@@ -0,0 +1,107 @@
+import os
+import uuid
+import pytest
+import requests
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+from main import CartItem, Category, Product, ProductStatus, User, UserRole, get_password_hash
+
+
+SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL", None)
+API_URL = os.environ.get("API_URL", "http://localhost:80")
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+@pytest.fixture(scope="module")
+def database():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+    TestingSessionLocal.configure(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def admin_headers(database):
+    suffix = uuid.uuid4().hex[:8]
+    password = uuid.uuid4().hex
+    db = TestingSessionLocal()
+    db.add(User(
+        email=f"delete_admin_{suffix}@test.com",
+        username=f"delete_admin_{suffix}",
+        hashed_password=get_password_hash(password),
+        role=UserRole.ADMIN,
+        is_active=True
+    ))
+    db.commit()
+    db.close()
+    response = requests.post(
+        f"{API_URL}/token",
+        data={"username": f"delete_admin_{suffix}", "password": password},
+        timeout=30
+    )
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+def vendor_product(database):
+    suffix = uuid.uuid4().hex[:8]
+    db = TestingSessionLocal()
+    vendor = User(
+        email=f"delete_vendor_{suffix}@test.com",
+        username=f"delete_vendor_{suffix}",
+        hashed_password="-",
+        role=UserRole.VENDOR,
+        is_active=True,
+        is_verified=True
+    )
+    category = Category(name=f"delete_{suffix}")
+    db.add_all([vendor, category])
+    db.flush()
+    product = Product(
+        name="Soon orphaned",
+        price=1000,
+        stock=10,
+        status=ProductStatus.APPROVED,
+        category_id=category.id,
+        vendor_id=vendor.id
+    )
+    db.add(product)
+    db.commit()
+    ids = (vendor.id, category.id, product.id)
+    db.close()
+    return ids
+
+
+def add_to_cart(session_id: str, product_id: int) -> requests.Response:
+    return requests.post(
+        f"{API_URL}/cart",
+        params={"session_id": session_id},
+        json={"product_id": product_id, "quantity": 1},
+        timeout=30
+    )
+
+
+@pytest.mark.parametrize("deleted", ["vendor", "category"])
+def test_products_of_deleted_parent_are_no_longer_sold(admin_headers, vendor_product, deleted):
+    vendor_id, category_id, product_id = vendor_product
+    session_id = uuid.uuid4().hex
+    assert requests.get(f"{API_URL}/products/{product_id}", timeout=30).status_code == 200
+    assert add_to_cart(session_id, product_id).status_code == 200
+
+    path = f"/admin/vendors/{vendor_id}" if deleted == "vendor" else f"/admin/categories/{category_id}"
+    response = requests.delete(f"{API_URL}{path}", headers=admin_headers, timeout=60)
+    assert response.status_code == 200, response.text
+
+    assert requests.get(f"{API_URL}/products/{product_id}", timeout=30).status_code == 404
+    assert add_to_cart(uuid.uuid4().hex, product_id).status_code == 404
+    assert product_id not in [p["id"] for p in requests.get(f"{API_URL}/products", timeout=30).json()]
+    # The cart that held the product is emptied rather than left with an unsellable item
+    response = requests.get(f"{API_URL}/cart/{session_id}", timeout=30)
+    assert response.status_code == 200 and response.json() == []
+
+    db = TestingSessionLocal()
+    product = db.get(Product, product_id)
+    assert product.status == ProductStatus.REJECTED
+    assert db.query(CartItem).filter(CartItem.product_id == product_id).count() == 0
+    db.close()